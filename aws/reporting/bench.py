@@ -0,0 +1,162 @@
+"""
+    Micro-benchmarks for the hot loops of the report pipeline,
+    run with: python ./bench.py [benchmark]
+"""
+
+import sys
+import random
+import timeit
+import tracemalloc
+from datetime import datetime, timezone
+
+from common import reformat_data
+from ec2 import EC2_KEYS
+
+def _legacy_reformat_data(data_items, keys):
+    """ reference implementation of reformat_data before key compilation """
+    data = []
+    for data_item in data_items:
+        current_data_item = {}
+        for key in keys:
+            split_keys = key.split('.')
+            data_entry = ''
+            if split_keys[0] == 'Tags':
+                for entry in data_item.get('Tags', []):
+                    if split_keys[-1] in entry['Key']:
+                        data_entry = entry['Value']
+            else:
+                data_entry = data_item
+                for split_key in split_keys:
+                    data_entry = data_entry.get(split_key, {})
+            if data_entry == {}:
+                data_entry = ''
+            current_data_item[split_keys[-1]] = data_entry
+        data.append(current_data_item)
+    return data
+
+def fake_instances(count, tags_per_instance=20, seed=0):
+    """ generates describe_instances-like items """
+    rnd = random.Random(seed)
+    instances = []
+    for i in range(count):
+        tags = [{'Key': 'kubernetes.io/cluster/c{}-{}'.format(i % 50, j), 'Value': 'owned'}
+                for j in range(tags_per_instance - 3)]
+        tags.extend([
+            {'Key': 'Name', 'Value': 'instance-{}'.format(i)},
+            {'Key': 'owner', 'Value': 'user{}@example.com'.format(i % 30)},
+            {'Key': 'guid', 'Value': 'guid-{}'.format(i % 200)},
+        ])
+        rnd.shuffle(tags)
+        instance = {
+            'InstanceId': 'i-{:017x}'.format(i),
+            'InstanceType': rnd.choice(['t2.large', 'm5.large', 'm5.xlarge', 'm5.2xlarge']),
+            'Placement': {'AvailabilityZone': rnd.choice(['us-east-1a', 'us-east-2b', 'eu-west-1c'])},
+            'LaunchTime': datetime(2022, 1 + i % 12, 1 + i % 28, tzinfo=timezone.utc),
+            'State': {'Name': 'running'},
+            'Tags': tags,
+        }
+        if i % 3:
+            instance['IamInstanceProfile'] = {'Arn': 'arn:aws:iam::123:instance-profile/p{}'.format(i)}
+        instances.append(instance)
+    return instances
+
+def bench_reformat(count=5000, repeat=5):
+    instances = fake_instances(count)
+    assert reformat_data(instances, EC2_KEYS) == _legacy_reformat_data(instances, EC2_KEYS)
+    legacy = min(timeit.repeat(lambda: _legacy_reformat_data(instances, EC2_KEYS), number=1, repeat=repeat))
+    compiled = min(timeit.repeat(lambda: reformat_data(instances, EC2_KEYS), number=1, repeat=repeat))
+    print("reformat_data {} instances x {} keys".format(count, len(EC2_KEYS)))
+    print("  legacy   : {:.1f} ms".format(legacy * 1000))
+    print("  compiled : {:.1f} ms ({:.1f}x)".format(compiled * 1000, legacy / compiled))
+
+def _traced_size(build):
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+def bench_records(count=50000):
+    instances = fake_instances(count, tags_per_instance=5)
+    _, dict_size = _traced_size(lambda: _legacy_reformat_data(instances, EC2_KEYS))
+    _, record_size = _traced_size(lambda: reformat_data(instances, EC2_KEYS))
+    print("projected {} instances".format(count))
+    print("  dicts   : {:.1f} MB".format(dict_size / 2**20))
+    print("  records : {:.1f} MB ({:.1f}x)".format(record_size / 2**20, dict_size / record_size))
+
+def bench_sheet_client(editors=7, repeat=3):
+    from google.auth.credentials import AnonymousCredentials
+    from googleapiclient.discovery import build
+    from sheet import build_sheets_service
+    creds = AnonymousCredentials()
+    # every editor used to build its own service, both read the bundled
+    # discovery document, the difference is the number of builds
+    legacy = min(timeit.repeat(lambda: [build('sheets', 'v4', credentials=creds) for _ in range(editors)],
+                                number=1, repeat=repeat))
+    shared = min(timeit.repeat(lambda: build_sheets_service(creds), number=1, repeat=repeat))
+    print("sheets client for {} editors".format(editors))
+    print("  per editor : {:.1f} ms".format(legacy * 1000))
+    print("  shared     : {:.1f} ms ({:.1f}x)".format(shared * 1000, legacy / shared))
+
+def _legacy_to_sheet_data(rows):
+    """ reference implementation of the dict path of to_sheet_data """
+    from sheet import to_cell
+    data = []
+    column_labels = []
+    for row in rows:
+        for k, v in row.items():
+            if k not in column_labels:
+                column_labels.append(k)
+        current_row = ['']*(max(len(column_labels), len(row.keys())))
+        for k, v in row.items():
+            idx = column_labels.index(k)
+            current_row[idx] = to_cell(k, v)
+        data.append(current_row)
+    return [column_labels]+data
+
+def _legacy_from_sheet_data(data):
+    """ reference implementation of from_sheet_data, pads data in place """
+    converted_data = []
+    columns = data[0]
+    for row in data[1:]:
+        row_dict = {}
+        while len(row) > len(columns):
+            columns.append('')
+        while len(columns) > len(row):
+            row.append('')
+        for idx, row_item in enumerate(row):
+            row_dict[columns[idx]] = row_item
+        converted_data.append(row_dict)
+    return converted_data
+
+def bench_sheet_data(count=50000, columns=20, repeat=3):
+    from sheet import GoogleSheetEditor
+    editor = GoogleSheetEditor('', '', client=object())
+    labels = ['Column{}'.format(c) for c in range(columns)]
+    rows = [dict((label, '{}-{}'.format(i, c)) for c, label in enumerate(labels)) for i in range(count)]
+    # trailing empty cells are left out by the sheets api
+    sheet_data = [labels] + [[row[label] for label in labels[:columns - i % 3]] for i, row in enumerate(rows)]
+    assert editor.to_sheet_data(rows) == _legacy_to_sheet_data(rows)
+    assert editor.from_sheet_data(sheet_data) == _legacy_from_sheet_data([list(r) for r in sheet_data])
+    legacy_to = min(timeit.repeat(lambda: _legacy_to_sheet_data(rows), number=1, repeat=repeat))
+    indexed_to = min(timeit.repeat(lambda: editor.to_sheet_data(rows), number=1, repeat=repeat))
+    legacy_from = min(timeit.repeat(lambda: _legacy_from_sheet_data([list(r) for r in sheet_data]),
+                                    number=1, repeat=repeat))
+    indexed_from = min(timeit.repeat(lambda: editor.from_sheet_data(sheet_data), number=1, repeat=repeat))
+    print("sheet data {} rows x {} columns".format(count, columns))
+    print("  to_sheet_data   legacy : {:.1f} ms".format(legacy_to * 1000))
+    print("  to_sheet_data   indexed: {:.1f} ms ({:.1f}x)".format(indexed_to * 1000, legacy_to / indexed_to))
+    print("  from_sheet_data legacy : {:.1f} ms".format(legacy_from * 1000))
+    print("  from_sheet_data indexed: {:.1f} ms ({:.1f}x)".format(indexed_from * 1000, legacy_from / indexed_from))
+
+BENCHMARKS = {
+    'reformat': bench_reformat,
+    'records': bench_records,
+    'sheet_client': bench_sheet_client,
+    'sheet_data': bench_sheet_data,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS.keys())
+    for name in names:
+        BENCHMARKS[name]()
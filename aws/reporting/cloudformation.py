@@ -1,6 +1,5 @@
-import boto3
 import logging
-from common import get_all_regions
+from common import sweep_regions, get_client, iter_pages
 
 DELETEABLE_STATUS = ["CREATE_FAILED", "DELETE_FAILED"]
 
@@ -12,8 +11,7 @@ logger = logging.getLogger(__name__)
 
 def get_deleteable_cf_templates(client):
     deleteable_stacks = []
-    response = client.describe_stacks()
-    for stack in response.get('Stacks', []):
+    for stack in iter_pages(client, 'describe_stacks', 'Stacks'):
         stackName = stack.get("StackName", "")
         if stackName != "":
             is_eks_managed = False
@@ -37,16 +35,20 @@ def does_cf_template_have_ec2_instances(client, stack_name: str):
     return False
 
 def delete_stacks(dry_run = False):
-    for region in get_all_regions():
-        client = boto3.client('cloudformation', region_name=region)
-        stacks = get_deleteable_cf_templates(client)
-        for stack in stacks:
-            stackName = stack.get("StackName", "")
-            if stackName != "":
-                try:
-                    logger.info("{} Attempting to delete stack {}".format(region, stackName))
-                    if not dry_run:
-                        client.delete_stack(StackName=stackName)
-                    logger.info("{} Deleted stack {}".format(region, stackName))
-                except:
-                    logger.info("{} Failed deleting stack {}".format(region, stackName))
+    def delete_stacks_in_region(region):
+        delete_stacks_per_region(region, dry_run)
+    sweep_regions(delete_stacks_in_region)
+
+def delete_stacks_per_region(region, dry_run = False):
+    client = get_client('cloudformation', region)
+    stacks = get_deleteable_cf_templates(client)
+    for stack in stacks:
+        stackName = stack.get("StackName", "")
+        if stackName != "":
+            try:
+                logger.info("{} Attempting to delete stack {}".format(region, stackName))
+                if not dry_run:
+                    client.delete_stack(StackName=stackName)
+                logger.info("{} Deleted stack {}".format(region, stackName))
+            except:
+                logger.info("{} Failed deleting stack {}".format(region, stackName))
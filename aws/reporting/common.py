@@ -1,48 +1,296 @@
+import os
+import time
 import boto3
-import pickle
-import datetime
+import boto3.session
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
 
-def get_all_regions():
-    regions = []
-    ec2client = boto3.client('ec2')
-    response = ec2client.describe_regions()
-    for r in response['Regions']:
-        regions.append(r['RegionName'])
+from records import Record, Schema, MISSING
+from snapshot import write_snapshot, Snapshot
+
+logger = logging.getLogger(__name__)
+
+# number of regions swept concurrently by collectors
+SWEEP_MAX_WORKERS = int(os.environ.get('SWEEP_MAX_WORKERS', '8'))
+
+# seconds for which the discovered region list is reused
+REGIONS_CACHE_TTL = int(os.environ.get('REGIONS_CACHE_TTL', '3600'))
+
+# comma separated lists of regions to restrict discovery to / to skip
+REGIONS_ALLOWLIST = os.environ.get('AWS_REGIONS_ALLOWLIST', '')
+REGIONS_DENYLIST = os.environ.get('AWS_REGIONS_DENYLIST', '')
+
+# connection pool size of each pooled client, should cover SWEEP_MAX_WORKERS
+CLIENT_MAX_POOL_CONNECTIONS = int(os.environ.get('CLIENT_MAX_POOL_CONNECTIONS', '25'))
+
+CLIENT_CONFIG = Config(
+    max_pool_connections=CLIENT_MAX_POOL_CONNECTIONS,
+    tcp_keepalive=True,
+    retries={'max_attempts': 5, 'mode': 'standard'},
+)
+
+# clients live at module level so that warm Lambda invocations reuse them
+_session = None
+_clients = {}
+_resources = {}
+_clients_lock = threading.Lock()
+
+def _get_session():
+    global _session
+    if _session is None:
+        _session = boto3.session.Session()
+    return _session
+
+def get_client(service, region=None):
+    """ returns a pooled boto3 client for (service, region)
+
+        clients are created once per process and are safe
+        to share between the sweep worker threads
+    """
+    key = (service, region)
+    client = _clients.get(key)
+    if client is None:
+        # sessions are not thread-safe, clients are created under the lock
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _get_session().client(service, region_name=region, config=CLIENT_CONFIG)
+                _clients[key] = client
+    return client
+
+def get_resource(service, region=None):
+    """ returns a pooled boto3 resource for (service, region)
+
+        unlike clients, resources are not thread-safe and
+        should only be used outside of the sweep workers
+    """
+    key = (service, region)
+    resource = _resources.get(key)
+    if resource is None:
+        with _clients_lock:
+            resource = _resources.get(key)
+            if resource is None:
+                resource = _get_session().resource(service, region_name=region, config=CLIENT_CONFIG)
+                _resources[key] = resource
+    return resource
+
+_regions_cache = {'regions': None, 'expires_at': 0.0}
+_regions_lock = threading.Lock()
+
+def _split_regions(value):
+    return [r.strip() for r in value.split(',') if r.strip()]
+
+def _discover_regions():
+    """ lists regions enabled for the account, opt-in regions
+        which are not opted in are skipped
+    """
+    ec2client = get_client('ec2')
+    response = ec2client.describe_regions(Filters=[
+        {
+            'Name': 'opt-in-status',
+            'Values': ['opt-in-not-required', 'opted-in']
+        }
+    ])
+    regions = sorted(r['RegionName'] for r in response['Regions'])
+    allowlist = _split_regions(REGIONS_ALLOWLIST)
+    denylist = _split_regions(REGIONS_DENYLIST)
+    if allowlist:
+        regions = [r for r in regions if r in allowlist]
+    if denylist:
+        regions = [r for r in regions if r not in denylist]
+    logger.info("Discovered {} regions: {}".format(len(regions), ', '.join(regions)))
     return regions
 
-def reformat_data(data_items, keys):
-    """ reformats data to compatible format for Google Sheets
+def get_all_regions():
+    """ returns enabled regions honouring the allowlist / denylist,
+        the list is discovered once and reused for REGIONS_CACHE_TTL seconds
+    """
+    with _regions_lock:
+        if _regions_cache['regions'] is None or time.monotonic() >= _regions_cache['expires_at']:
+            _regions_cache['regions'] = _discover_regions()
+            _regions_cache['expires_at'] = time.monotonic() + REGIONS_CACHE_TTL
+        return list(_regions_cache['regions'])
 
-        data_items (list): list of dicts, each item corresponds to an AWS resource
-        keys (list): list of strings, keys in the original data to preserve,
-                        all other keys in the original data will be removed
+def iter_region_results(func, regions=None, max_workers=None, failures=None):
+    """ runs func(region) for every region on a bounded worker pool
+
+        func (callable): per-region collector, receives the region name
+        regions (list): regions to sweep, defaults to all regions
+        failures (dict): when given, receives region -> exception of
+                        every region that failed
+
+        yields (region, result) in the order of the region list as soon as
+        the result of a region is ready, regions that failed are logged
+        and skipped, callers must check failures before treating the
+        results as the complete inventory
+    """
+    if regions is None:
+        regions = get_all_regions()
+    if max_workers is None:
+        max_workers = SWEEP_MAX_WORKERS
+    if failures is None:
+        failures = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(regions) or 1))) as executor:
+        futures = [(region, executor.submit(func, region)) for region in regions]
+        for region, future in futures:
+            try:
+                result = future.result()
+            except Exception as e:
+                failed.append(region)
+                failures[region] = e
+                logger.info("{} Error sweeping region with {}".format(region, getattr(func, '__name__', func)))
+                logger.error(str(e))
+                continue
+            yield region, result
+    if failed:
+        logger.error("Sweep {} failed in {} of {} regions: {}".format(
+            getattr(func, '__name__', func), len(failed), len(regions), ', '.join(failed)))
+
+def sweep_regions(func, regions=None, max_workers=None, failures=None):
+    """ returns a dict of region -> func(region), ordered like the region
+        list, see iter_region_results
+    """
+    return dict(iter_region_results(func, regions, max_workers, failures))
+
+def merge_region_results(results):
+    """ flattens a region -> list mapping returned by sweep_regions
+    """
+    merged = []
+    for items in results.values():
+        merged.extend(items)
+    return merged
+
+def iter_pages(client, operation, result_key, **kwargs):
+    """ yields every item of a paginated describe / list call,
+        one page is held in memory at a time
+    """
+    paginator = client.get_paginator(operation)
+    for page in paginator.paginate(**kwargs):
+        for item in page.get(result_key, []):
+            yield item
+
+def build_filters(rules):
+    """ turns selection rules into AWS describe call Filters so
+        that unwanted resources are dropped server-side
+
+        rules (dict): filter name -> value or list of values, e.g.
+                        {'instance-state-name': 'running', 'tag-key': ['owner', 'guid']}
     """
-    data = []
-    for data_item in data_items:
-        current_data_item = {}
-        for key in keys:
+    filters = []
+    for name, values in rules.items():
+        if not isinstance(values, (list, tuple, set)):
+            values = [values]
+        filters.append({
+            'Name': name,
+            'Values': [str(v) for v in values]
+        })
+    return filters
+
+class KeyExtractor(object):
+    """ projects AWS resources down to a list of dotted keys
+
+        the keys are split once when the extractor is built,
+        'Tags.<name>' keys pick the value of the last tag whose
+        key contains <name>, other keys walk nested dicts
+
+        projected items are records, items of one collection share
+        a schema from new_schema() so it does not grow across callers
+    """
+    def __init__(self, keys):
+        self.keys = list(keys)
+        # output column names in key order
+        self.columns = []
+        # (column, position, path) tuples, path is None for tag keys
+        self._getters = []
+        self._tag_names = []
+        # tag key -> names of requested tags matched by that key
+        self._tag_matches = {}
+        for key in self.keys:
             split_keys = key.split('.')
-            data_entry = ''
+            column = split_keys[-1]
+            if column not in self.columns:
+                self.columns.append(column)
+            idx = self.columns.index(column)
             if split_keys[0] == 'Tags':
-                for entry in data_item.get('Tags', []):
-                    if split_keys[-1] in entry['Key']:
-                        data_entry = entry['Value']
+                self._getters.append((column, idx, None))
+                if column not in self._tag_names:
+                    self._tag_names.append(column)
+            else:
+                self._getters.append((column, idx, tuple(split_keys)))
+
+    def new_schema(self):
+        """ returns a schema for the records of a single collection """
+        return Schema(self.columns)
+
+    def _match_tag_key(self, tag_key):
+        matches = self._tag_matches.get(tag_key)
+        if matches is None:
+            matches = tuple(name for name in self._tag_names if name in tag_key)
+            self._tag_matches[tag_key] = matches
+        return matches
+
+    def _extract_tags(self, data_item):
+        """ scans the tag list of the item once """
+        tags = {}
+        tag_matches = self._tag_matches
+        for entry in data_item.get('Tags', ()):
+            tag_key = entry['Key']
+            matches = tag_matches.get(tag_key)
+            if matches is None:
+                matches = self._match_tag_key(tag_key)
+            for name in matches:
+                tags[name] = entry['Value']
+        return tags
+
+    def __call__(self, data_item, schema=None):
+        tags = self._extract_tags(data_item) if self._tag_names else None
+        values = [MISSING] * len(self.columns)
+        for column, idx, path in self._getters:
+            if path is None:
+                data_entry = tags.get(column, '')
+            elif len(path) == 1:
+                data_entry = data_item.get(path[0], '')
             else:
                 data_entry = data_item
-                for split_key in split_keys:
+                for split_key in path:
                     data_entry = data_entry.get(split_key, {})
             if data_entry == {}:
                 data_entry = ''
-            current_data_item[split_keys[-1]] = data_entry
-        data.append(current_data_item)
-    return data
+            values[idx] = data_entry
+        return Record(schema if schema is not None else self.new_schema(), values)
+
+_extractors = {}
+
+def compile_keys(keys):
+    """ returns a KeyExtractor for the keys, extractors are shared per key list
+    """
+    cache_key = tuple(keys)
+    extractor = _extractors.get(cache_key)
+    if extractor is None:
+        extractor = KeyExtractor(cache_key)
+        _extractors[cache_key] = extractor
+    return extractor
+
+def reformat_data(data_items, keys):
+    """ reformats data to compatible format for Google Sheets
+
+        data_items (list): list of dicts, each item corresponds to an AWS resource
+        keys (list): list of strings, keys in the original data to preserve,
+                        all other keys in the original data will be removed
+
+        returns list of records sharing one schema
+    """
+    extractor = compile_keys(keys)
+    schema = extractor.new_schema()
+    return [extractor(data_item, schema) for data_item in data_items]
 
-def save_to_file(data, filename):
-    with open('./{}'.format(filename), 'wb') as fp:
-        pickle.dump(data, fp, protocol=pickle.HIGHEST_PROTOCOL)
+def save_to_file(tables, filename):
+    """ writes tables (name -> list of dicts or records) as a snapshot """
+    write_snapshot(filename, tables)
 
 def load_from_file(filename):
-    data = None
-    with open(filename, 'rb') as fp:
-        data = pickle.load(fp)
-    return data
+    """ returns the snapshot written by save_to_file, close it when done """
+    return Snapshot(filename)
@@ -1,112 +1,194 @@
 # cost models for different dev environments
+import os
+import json
 from datetime import datetime
 from math import ceil
 
-from pricing import get_price_for_instance
-
-models_ec2 = {
-    'ocp-dev-3': [
-        (1, 't2.large'),
-        (1, 'm5.large'),
-        (1, 'm5.2xlarge'),
-        (3, 'm5.xlarge'),
-        (3, 'm5.large')
-    ],
-    'ocp-dev-4': [
-        (1, 't2.medium'),
-        (3, 'm5.xlarge'),
-        (3, 'm5.xlarge')
-    ],
-    'ocs-dev-4': [
-        (1, 't2.medium'),
-        (3, 'm5.2xlarge'),
-        (3, 'm5.2xlarge')
-    ]
-}
-
-considered_regions = [
-    'us-east-1',
-    'us-east-2',
-    'us-west-1',
-    'us-west-2',
-    'eu-central-1',
-    'eu-west-1',
-    # 'eu-west-2'
-]
-
-def get_avg_cost_for_ec2_model(model):
-    model_cost = []
-    for count, instance_type in models_ec2[model]:
-        avg_cost = 0.0
-        for r in considered_regions:
-            avg_cost += get_price_for_instance(instance_type, r) * 24.0 * 30
-        avg_cost /= len(considered_regions)
-        avg_cost *= count
-        avg_cost = ceil(avg_cost)
-        model_cost.append((count, instance_type, avg_cost))
-    return model_cost
-
-def to_rich_text(model):
+from common import get_all_regions
+from pricing import prefetch_prices, ec2_pricing_cache, get_price_cache
+
+# model definitions, see cost_models.json
+COST_MODELS_PATH = os.environ.get('COST_MODELS_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cost_models.json'))
+
+HOURS_PER_MONTH = 24.0 * 30
+
+def load_cost_models(path=COST_MODELS_PATH):
+    """ loads model definitions
+
+        returns dict with 'models' (name -> {'title', 'instances': [(count, type)]}),
+        'groups' and 'region_mixes' (name -> {region: weight})
+    """
+    with open(path) as fp:
+        config = json.load(fp)
+    for model in config['models'].values():
+        model['instances'] = [(int(count), instance_type) for count, instance_type in model['instances']]
+    config.setdefault('groups', [])
+    config.setdefault('region_mixes', {})
+    return config
+
+def considered_regions():
+    """ regions we are in, shares the cached region list with the collectors,
+        narrow it down with AWS_REGIONS_ALLOWLIST / AWS_REGIONS_DENYLIST
+    """
+    return get_all_regions()
+
+def build_price_matrix(instance_types, regions):
+    """ returns (type x region) matrix of hourly prices, all prices
+        are resolved in a single prefetch, unknown prices are None
+    """
+    prefetch_prices(instance_keys=[(t, r) for t in instance_types for r in regions])
+    return [[ec2_pricing_cache.get(t, {}).get(r) for r in regions] for t in instance_types]
+
+def evaluate_models(models, regions, region_mixes=None):
+    """ evaluates monthly costs of all models over all regions in one pass
+
+        models (dict): name -> list of (count, instance type)
+        regions (list): regions to price the models in
+        region_mixes (dict): name -> {region: weight}, weighted averages
+                                to report in addition to the plain average
+
+        returns dict of model name -> {
+            'regions': {region: monthly cost, None if a price is unknown},
+            'min', 'avg', 'max': over the regions with a known cost,
+            'mixes': {mix name: weighted average},
+            'instances': [(count, type, average monthly cost, None if no price is known)],
+            'priced_regions': {type: number of regions the average covers}
+        }
+    """
+    region_mixes = region_mixes or {}
+    instance_types = sorted(set(t for instances in models.values() for _, t in instances))
+    type_index = dict((t, i) for i, t in enumerate(instance_types))
+    prices = build_price_matrix(instance_types, regions)
+
+    # per type averages over the regions with a known price
+    avg_prices = []
+    priced_regions = []
+    for row in prices:
+        known = [p for p in row if p is not None]
+        avg_prices.append(sum(known) / len(known) if known else None)
+        priced_regions.append(len(known))
+
+    # mix weights as vectors over the region axis
+    mix_weights = {}
+    for mix_name, weights in region_mixes.items():
+        mix_weights[mix_name] = [float(weights.get(r, 0.0)) for r in regions]
+
+    results = {}
+    for name, instances in models.items():
+        # (model x type) counts times (type x region) prices
+        counts = [0] * len(instance_types)
+        for count, instance_type in instances:
+            counts[type_index[instance_type]] += count
+        used = [i for i, c in enumerate(counts) if c]
+        region_costs = []
+        for r in range(len(regions)):
+            column = [prices[i][r] for i in used]
+            if None in column:
+                region_costs.append(None)
+            else:
+                region_costs.append(sum(counts[i] * p for i, p in zip(used, column)) * HOURS_PER_MONTH)
+        known = [c for c in region_costs if c is not None]
+        mixes = {}
+        for mix_name, weights in mix_weights.items():
+            pairs = [(w, c) for w, c in zip(weights, region_costs) if w and c is not None]
+            total_weight = sum(w for w, _ in pairs)
+            mixes[mix_name] = sum(w * c for w, c in pairs) / total_weight if total_weight else None
+        line_items = []
+        for count, instance_type in instances:
+            avg_price = avg_prices[type_index[instance_type]]
+            avg_cost = ceil(avg_price * HOURS_PER_MONTH * count) if avg_price is not None else None
+            line_items.append((count, instance_type, avg_cost))
+        results[name] = {
+            'regions': dict(zip(regions, region_costs)),
+            'min': min(known) if known else None,
+            'avg': sum(known) / len(known) if known else None,
+            'max': max(known) if known else None,
+            'mixes': mixes,
+            'instances': line_items,
+            'priced_regions': dict((t, priced_regions[type_index[t]]) for _, t in instances),
+        }
+    return results
+
+def get_avg_cost_for_ec2_model(model, config=None):
+    config = config or load_cost_models()
+    models = {model: config['models'][model]['instances']}
+    return evaluate_models(models, considered_regions())[model]['instances']
+
+def to_rich_text(model, priced_regions=None, region_count=None):
+    """ priced_regions (dict): type -> regions the average covers, types
+        priced in fewer than region_count regions are flagged
+    """
     text = ""
     for m in model:
+        coverage = ""
+        covered = (priced_regions or {}).get(m[1])
+        if m[2] is not None and covered is not None and region_count and covered < region_count:
+            coverage = " (average of {} of {} regions)".format(covered, region_count)
         text += """
-{} x {} = ${}
-""".format(m[0], m[1], m[2])
+{} x {} = {}{}
+""".format(m[0], m[1], _format_cost(m[2]), coverage)
     return text
 
 def get_total_for_model(model):
+    """ total of the line items with a known cost """
     total = 0.0
     for m in model:
-        total += m[2]
+        if m[2] is not None:
+            total += m[2]
     return total
 
+def get_unpriced_items(model):
+    """ line items without a known price, left out of the total """
+    return [m for m in model if m[2] is None]
+
+def _format_cost(cost):
+    return "n/a" if cost is None else "${}".format(ceil(cost))
+
 if __name__ == "__main__":
     summary = """
 Updated On: {}
 
-Following is a summary of costs for different development environmets used by Migration devs. 
+Following is a summary of costs for different development environmets used by Migration devs.
 
-The estimation is based on latest costs of EC2 instances averaged over all regions we are in.
+The estimation is based on latest costs of EC2 instances averaged over the regions we are in
+which have a known price, types priced in fewer regions are marked.
 
 The instance sizes are assumed based on defaults in mig-agnosticd.
-
-OCP 3 -> 4 Environment
-
-OCP 3
 {}
-Total : ${}
-
-OCP 4
-{}
-Total : ${}
-
-OCS 3 -> 4 Environments
-
-OCS 3
+"""
+    section = """
 {}
-Total : ${}
-
-OCS 4
 {}
-Total : ${}
-
+Total : ${}{}
+Min / Avg / Max over regions : {} / {} / {}
 """
     # document_id = os.environ['DOC_ID']
     now = (datetime.utcnow()).strftime("%a, %b %d, %y")
-    ocp3_model = get_avg_cost_for_ec2_model('ocp-dev-3')
-    ocp4_model = get_avg_cost_for_ec2_model('ocp-dev-4')
-    ocs3_model = get_avg_cost_for_ec2_model('ocp-dev-3')
-    ocs4_model = get_avg_cost_for_ec2_model('ocs-dev-4')
+    config = load_cost_models()
+    models = dict((name, model['instances']) for name, model in config['models'].items())
+    regions = considered_regions()
+    results = evaluate_models(models, regions, config['region_mixes'])
     # googleDocEditor = GoogleDocEditor(document_id)
 
-    summary = summary.format(
-        now, 
-        to_rich_text(ocp3_model), get_total_for_model(ocp3_model), 
-        to_rich_text(ocp4_model), get_total_for_model(ocp4_model),
-        to_rich_text(ocs3_model), get_total_for_model(ocs3_model),
-        to_rich_text(ocs4_model), get_total_for_model(ocs4_model)
-        )
-    
-    print(summary)
+    groups = config['groups'] or [{'title': '', 'models': list(models.keys())}]
+    sections = ""
+    for group in groups:
+        sections += "\n{}\n".format(group['title'])
+        for name in group['models']:
+            result = results[name]
+            unpriced = get_unpriced_items(result['instances'])
+            sections += section.format(
+                config['models'][name].get('title', name),
+                to_rich_text(result['instances'], result['priced_regions'], len(regions)),
+                get_total_for_model(result['instances']),
+                " (excludes {} without a known price)".format(
+                    ", ".join(m[1] for m in unpriced)) if unpriced else "",
+                _format_cost(result['min']), _format_cost(result['avg']), _format_cost(result['max']))
+            for mix_name, cost in result['mixes'].items():
+                sections += "Region mix {} : {}\n".format(mix_name, _format_cost(cost))
+
+    summary = summary.format(now, sections)
 
-    
+    print(summary)
+    print("Price cache {}".format(get_price_cache().stats()))
@@ -0,0 +1,80 @@
+"""
+    Daily cost of collected resources other than
+    EC2 instances and ELBs, priced in a single batch
+"""
+
+from pricing import prefetch_resource_prices, get_cached_resource_price, \
+    volume_price_query, idle_eip_price_query, nat_gateway_price_query, \
+    s3_storage_price_query
+
+DAYS_PER_MONTH = 30
+
+HOURS_PER_DAY = 24
+
+# per resource daily cost column
+COST_COLUMN = 'CostPerDay'
+
+def _volume_query(volume):
+    return volume_price_query(volume['VolumeType'], volume['Region'])
+
+def _volume_daily_cost(volume, price_per_gb_month):
+    return price_per_gb_month * volume['Size'] / DAYS_PER_MONTH
+
+def _eip_query(eip):
+    # addresses in use are billed as part of what they are attached to
+    if eip.get('InstanceId', '') != '' or eip.get('AssociationId', '') != '':
+        return None
+    return idle_eip_price_query(eip['Region'])
+
+def _eip_daily_cost(eip, price_per_hour):
+    return price_per_hour * HOURS_PER_DAY
+
+def _nat_gateway_query(gateway):
+    return nat_gateway_price_query(gateway['Region'])
+
+def _nat_gateway_daily_cost(gateway, price_per_hour):
+    return price_per_hour * HOURS_PER_DAY
+
+def _bucket_query(bucket):
+    if not bucket.get('Region'):
+        return None
+    return s3_storage_price_query(bucket['Region'])
+
+def _bucket_daily_cost(bucket, price_per_gb_month):
+    return price_per_gb_month * bucket.get('SizeGB', 0.0) / DAYS_PER_MONTH
+
+# resource type -> (price query of a resource, daily cost from price)
+RESOURCE_PRICING = {
+    'volumes': (_volume_query, _volume_daily_cost),
+    'eips': (_eip_query, _eip_daily_cost),
+    'nat_gateways': (_nat_gateway_query, _nat_gateway_daily_cost),
+    'buckets': (_bucket_query, _bucket_daily_cost),
+}
+
+def price_resources(inventory):
+    """ prices all resources of the inventory in one batch and sets
+        their numeric COST_COLUMN, resources without known price cost 0
+
+        inventory (dict): resource type in RESOURCE_PRICING -> list of resources
+
+        returns dict of resource type -> total daily cost
+    """
+    queries = {}
+    for resource_type, resources in inventory.items():
+        query = RESOURCE_PRICING[resource_type][0]
+        queries[resource_type] = [query(resource) for resource in resources]
+    prefetch_resource_prices([q for type_queries in queries.values() for q in type_queries if q is not None])
+    totals = {}
+    for resource_type, resources in inventory.items():
+        daily_cost = RESOURCE_PRICING[resource_type][1]
+        total = 0.0
+        for resource, query in zip(resources, queries[resource_type]):
+            cost = 0.0
+            if query is not None:
+                price = get_cached_resource_price(query[2])
+                if price is not None:
+                    cost = daily_cost(resource, price)
+            resource[COST_COLUMN] = cost
+            total += cost
+        totals[resource_type] = total
+    return totals
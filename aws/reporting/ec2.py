@@ -1,8 +1,8 @@
 import re
-import boto3
 import logging
-from pricing import calculate_bill_for_instance
-from common import reformat_data, get_all_regions
+from pricing import calculate_bills_for_instances
+from common import reformat_data, sweep_regions, merge_region_results, get_client, \
+    iter_pages, compile_keys, build_filters, iter_region_results
 
 logger = logging.getLogger(__name__)
 
@@ -17,48 +17,84 @@ EC2_KEYS = [
     'Tags.guid'
 ]
 
-def get_all_instances():
-    all_instances = []
-    for r in get_all_regions():
-        instances_in_region = get_instances_per_region(r)
-        all_instances.extend(instances_in_region)
-    return all_instances
-
-def get_instances_per_region(region):
-    instances = []
-    ec2client = boto3.client('ec2',region_name=region)
-    response = ec2client.describe_instances()
-    for reservation in response["Reservations"]:
+_project_instance = compile_keys(EC2_KEYS)
+
+# columns of the instances returned by reformat_instance_data
+INSTANCE_COLUMNS = _project_instance.columns + ['TotalBill', 'Cost Per Day']
+
+# selection rules pushed down to the describe calls
+RUNNING_INSTANCE_RULES = {
+    'instance-state-name': ['running'],
+}
+
+UNUSED_VOLUME_RULES = {
+    'status': ['available', 'error'],
+}
+
+# number of instance ids sent in a single terminate_instances call
+TERMINATE_BATCH_SIZE = 100
+
+def get_all_instances(failures=None):
+    """ returns running instances of all regions projected to EC2_KEYS,
+        regions which could not be swept are added to failures
+    """
+    return [instance for instances in iter_all_instances(failures) for instance in instances]
+
+def iter_all_instances(failures=None):
+    """ yields the instances of each region, projected to EC2_KEYS, as soon
+        as the region is swept, in region order, regions which could not be
+        swept are added to failures
+    """
+    schema = _project_instance.new_schema()
+    def instances_in_region(region):
+        return get_instances_per_region(region, schema=schema)
+    for _, instances in iter_region_results(instances_in_region, failures=failures):
+        yield instances
+
+def get_instances_per_region(region, rules=RUNNING_INSTANCE_RULES, schema=None):
+    return list(iter_instances_per_region(region, rules, schema))
+
+def iter_instances_per_region(region, rules=RUNNING_INSTANCE_RULES, schema=None):
+    """ yields instances of the region matching the rules page by page,
+        each instance is projected to EC2_KEYS as soon as it arrives
+    """
+    if schema is None:
+        schema = _project_instance.new_schema()
+    ec2client = get_client('ec2', region)
+    filters = build_filters(rules)
+    for reservation in iter_pages(ec2client, 'describe_instances', 'Reservations', Filters=filters):
         for instance in reservation["Instances"]:
-            if instance['State']['Name'] == 'running':
-                instances.append(instance)
-                logger.info("{} Found instance {}".format(region, instance['InstanceId']))
-    return instances
-
-def reformat_instance_data(raw_instances):
-    formatted_instances = reformat_data(raw_instances, EC2_KEYS)
-    for inst in formatted_instances:
-        region = re.sub(r'(\w+)-(\w+)-(\d)\w+', r"\g<1>-\g<2>-\g<3>", inst["AvailabilityZone"])
-        instance_type = inst['InstanceType']
-        launch_time = inst['LaunchTime']
-        try:
-            inst['TotalBill'] = "${}".format(calculate_bill_for_instance(instance_type, region, launch_time)[2])
-        except:
-            inst['TotalBill'] = "$0"
-        try:
-            inst['Cost Per Day'] = "${}".format(calculate_bill_for_instance(instance_type, region, launch_time)[1])
-        except:
-            inst['Cost Per Day'] = "$0"
+            logger.info("{} Found instance {}".format(region, instance['InstanceId']))
+            yield _project_instance(instance, schema)
+
+def reformat_instance_data(formatted_instances, utc_now=None, flush=True):
+    """ adds billing info to instances already projected to EC2_KEYS,
+        batches of one report share utc_now and flush the price cache
+        once, see calculate_bills_for_instances
+    """
+    regions = [re.sub(r'(\w+)-(\w+)-(\d)\w+', r"\g<1>-\g<2>-\g<3>", inst["AvailabilityZone"])
+                for inst in formatted_instances]
+    bills = calculate_bills_for_instances(
+        [inst['InstanceType'] for inst in formatted_instances],
+        regions,
+        [inst['LaunchTime'] for inst in formatted_instances],
+        utc_now, flush)
+    for inst, bill in zip(formatted_instances, bills):
+        if bill is None:
+            inst['TotalBill'] = 0.0
+            inst['Cost Per Day'] = 0.0
+        else:
+            inst['TotalBill'] = bill[2]
+            inst['Cost Per Day'] = bill[1]
     return formatted_instances
 
-def get_all_eips():
-    all_eips = []
-    for region in get_all_regions():
-        client = boto3.client('ec2', region_name=region)
-        response = client.describe_addresses()
-        if response['Addresses']:
-            all_eips.extend(response['Addresses'])
-    return all_eips
+def get_all_eips(failures=None):
+    return merge_region_results(sweep_regions(get_eips_per_region, failures=failures))
+
+def get_eips_per_region(region, rules=None):
+    client = get_client('ec2', region)
+    response = client.describe_addresses(Filters=build_filters(rules or {}))
+    return response['Addresses']
 
 def reformat_eips_data(raw_eips):
     keys = [
@@ -67,6 +103,7 @@ def reformat_eips_data(raw_eips):
         'AllocationId',
         'NetworkBorderGroup',
         'InstanceId',
+        'AssociationId',
         'Tags.guid',
         'Tags.owner'
     ]
@@ -78,28 +115,23 @@ def reformat_eips_data(raw_eips):
     return eips
 
 def get_all_unused_volumes():
-    all_volumes = []
-    for region in get_all_regions():
-        vols = []
-        client = boto3.client('ec2', region_name=region)
-        filters = [
-            {
-                'Name': 'status',
-                'Values': ['available', 'error']
-            }
-        ]
-        for vol in client.describe_volumes(Filters=filters)['Volumes']:
-            vol['Region'] = region
-            vols.append(vol)
-            logger.info("{} Found unused vol {}".format(region, vol))
-        all_volumes.extend(vols)
-    return all_volumes
+    return merge_region_results(sweep_regions(get_unused_volumes_per_region))
+
+def get_unused_volumes_per_region(region, rules=UNUSED_VOLUME_RULES):
+    vols = []
+    client = get_client('ec2', region)
+    filters = build_filters(rules)
+    for vol in iter_pages(client, 'describe_volumes', 'Volumes', Filters=filters):
+        vol['Region'] = region
+        vols.append(vol)
+        logger.info("{} Found unused vol {}".format(region, vol))
+    return vols
 
 def delete_volume(volume_id, region):
     response = {}
     try:
         logger.info("{} Attempting to delete vol {}".format(region, volume_id))
-        response = boto3.client('ec2', region_name=region).delete_volume(VolumeId=volume_id)
+        response = get_client('ec2', region).delete_volume(VolumeId=volume_id)
     except Exception as e:
         logger.info("{} Error deleting vol {}".format(region, volume_id))
         logger.error(str(e))
@@ -110,21 +142,44 @@ def delete_eip(eip):
     region = eip.get('NetworkBorderGroup', '')
     try:
         logger.info("{} Attempting to delete eip {}".format(region, eip['AllocationId']))
-        if region != '':
-            ec2Client = boto3.client('ec2', region_name=region)
-        else:
-            ec2Client = boto3.client('ec2')
+        ec2Client = get_client('ec2', region or None)
         response = ec2Client.release_address(AllocationId=eip['AllocationId'])
     except Exception as e:
         logger.info("{} Error deleting eip {}".format(region, eip['AllocationId']))
         logger.error(str(e))
     return response
 
+def terminate_instances_in_region(instance_ids, region):
+    """ terminates instances of a region in multi-id batches
+
+        a batch is rejected as a whole when one of its ids is invalid,
+        such batches are retried one instance at a time so that a single
+        bad id does not save the rest of the batch
+
+        returns list of ids of the instances being terminated
+    """
+    terminated = []
+    client = get_client('ec2', region)
+    for i in range(0, len(instance_ids), TERMINATE_BATCH_SIZE):
+        batch = instance_ids[i:i+TERMINATE_BATCH_SIZE]
+        try:
+            logger.info("{} Attempting to terminate instances {}".format(region, batch))
+            response = client.terminate_instances(InstanceIds=batch)
+            terminated.extend(inst['InstanceId'] for inst in response.get('TerminatingInstances', []))
+        except Exception as e:
+            logger.info("{} Error terminating batch of {} instances, retrying one by one".format(region, len(batch)))
+            logger.error(str(e))
+            for instance_id in batch:
+                response = terminate_instance(instance_id, region)
+                if response.get('ResponseMetadata', {}).get('HTTPStatusCode', 500) == 200:
+                    terminated.append(instance_id)
+    return terminated
+
 def terminate_instance(instance_id, region):
     response = {}
     try:
         logger.info("{} Attempting to terminate instance {}".format(region, instance_id))
-        response = boto3.client('ec2', region_name=region).terminate_instances(InstanceIds=[instance_id])
+        response = get_client('ec2', region).terminate_instances(InstanceIds=[instance_id])
     except Exception as e:
         logger.info("{} Error terminating instance {}".format(region, instance_id))
         logger.error(str(e))
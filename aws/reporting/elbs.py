@@ -1,35 +1,66 @@
 import re
-import boto3
 import logging
-from pricing import calculate_bill_for_elb
-from common import reformat_data, get_all_regions
+from pricing import calculate_bills_for_elbs
+from common import iter_region_results, get_client, iter_pages, compile_keys
 
 logger = logging.getLogger(__name__)
 
-def get_all_elbs():
-    elbs = []
-    for region in get_all_regions():
-        # classic elbs
-        client = boto3.client('elb', region_name=region)
-        response = client.describe_load_balancers()
-        elbs.extend(response['LoadBalancerDescriptions'])
-        # application + network
-        client = boto3.client('elbv2', region_name=region)
-        response = client.describe_load_balancers()
-        elbs.extend(response['LoadBalancers'])
-    return elbs
+ELB_KEYS = [
+    'LoadBalancerName',
+    'AvailabilityZones',
+    'VPCId',
+    'CreatedTime',
+    'Instances',
+    'Type',
+    'State.Code'
+]
+
+_project_elb = compile_keys(ELB_KEYS)
+
+# columns of the elbs returned by reformat_elbs_data, Status is only set on network elbs
+ELB_COLUMNS = [column for column in _project_elb.columns if column not in ('AvailabilityZones', 'Code')] \
+    + ['Status', 'Region', 'TotalBill', 'CostPerDay']
+
+def get_all_elbs(failures=None):
+    """ returns load balancers of all regions projected to ELB_KEYS,
+        regions which could not be swept are added to failures
+    """
+    return [elb for elbs in iter_all_elbs(failures) for elb in elbs]
+
+def iter_all_elbs(failures=None):
+    """ yields the load balancers of each region, projected to ELB_KEYS,
+        as soon as the region is swept, in region order, regions which
+        could not be swept are added to failures
+    """
+    schema = _project_elb.new_schema()
+    def elbs_in_region(region):
+        return get_elbs_per_region(region, schema)
+    for _, elbs in iter_region_results(elbs_in_region, failures=failures):
+        yield elbs
+
+def get_elbs_per_region(region, schema=None):
+    return list(iter_elbs_per_region(region, schema))
+
+def iter_elbs_per_region(region, schema=None):
+    """ yields classic, application and network load balancers
+        of the region page by page, projected to ELB_KEYS
+    """
+    if schema is None:
+        schema = _project_elb.new_schema()
+    # classic elbs
+    client = get_client('elb', region)
+    for elb in iter_pages(client, 'describe_load_balancers', 'LoadBalancerDescriptions'):
+        yield _project_elb(elb, schema)
+    # application + network
+    client = get_client('elbv2', region)
+    for elb in iter_pages(client, 'describe_load_balancers', 'LoadBalancers'):
+        yield _project_elb(elb, schema)
 
-def reformat_elbs_data(elbs):
-    keys = [
-        'LoadBalancerName',
-        'AvailabilityZones',
-        'VPCId',
-        'CreatedTime',
-        'Instances',
-        'Type',
-        'State.Code'
-    ]
-    elbs = reformat_data(elbs, keys)
+def reformat_elbs_data(elbs, utc_now=None, flush=True):
+    """ adds region and billing info to elbs already projected to ELB_KEYS,
+        batches of one report share utc_now and flush the price cache
+        once, see calculate_bills_for_elbs
+    """
     for elb in elbs:
         if elb['Type'] == '':
             elb['Type'] = 'classic'
@@ -45,8 +76,18 @@ def reformat_elbs_data(elbs):
             else:
                 az = elb['AvailabilityZones'][0]
             elb['Region'] = re.sub(r'(\w+)-(\w+)-(\d)\w+', r"\g<1>-\g<2>-\g<3>", az)
-        elb['TotalBill'] = "${}".format(calculate_bill_for_elb(elb['Type'], elb['Region'], elb['CreatedTime'])[2])
-        elb['CostPerDay'] = "${}".format(calculate_bill_for_elb(elb['Type'], elb['Region'], elb['CreatedTime'])[1])
+    bills = calculate_bills_for_elbs(
+        [elb['Type'] for elb in elbs],
+        [elb.get('Region', '') for elb in elbs],
+        [elb['CreatedTime'] for elb in elbs],
+        utc_now, flush)
+    for elb, bill in zip(elbs, bills):
+        if bill is None:
+            elb['TotalBill'] = 0.0
+            elb['CostPerDay'] = 0.0
+        else:
+            elb['TotalBill'] = bill[2]
+            elb['CostPerDay'] = bill[1]
         if 'AvailabilityZones' in elb:
             del elb['AvailabilityZones']
         if 'Code' in elb:
@@ -57,7 +98,7 @@ def delete_classic_elb(elb_name, region):
     response = {}
     try:
         logger.info("{} Attempting to delete elb {}".format(region, elb_name))
-        response = boto3.client('elb', region_name=region).delete_load_balancer(LoadBalancerName=elb_name)
+        response = get_client('elb', region).delete_load_balancer(LoadBalancerName=elb_name)
     except Exception as e:
         logger.info("{} Error deleting elb {}".format(region, elb_name))
         logger.error(str(e))
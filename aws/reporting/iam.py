@@ -1,7 +1,7 @@
 import datetime
 import re
 
-import boto3
+from common import get_client, get_resource
 
 
 def get_all_users():
@@ -10,9 +10,9 @@ def get_all_users():
     marker = ''
     while isTruncated:
         if marker:
-            response = boto3.client('iam').list_users(Marker=marker)
+            response = get_client('iam').list_users(Marker=marker)
         else:
-            response = boto3.client('iam').list_users()
+            response = get_client('iam').list_users()
         paginatedUsers = response['Users']
         users.extend(paginatedUsers)
         isTruncated = response.get('IsTruncated', False)
@@ -28,12 +28,12 @@ def get_old_users(users, createdThreshold=60, lastUsedThreshold=120):
     i = 1
     for user in users:
         print("{} Analyzing user {}".format(i, user['UserName']))
-        userResource = boto3.resource('iam').User(user['UserName'])
+        userResource = get_resource('iam').User(user['UserName'])
         allUsageDates = []
         if isinstance(userResource.password_last_used, datetime.date):
             allUsageDates.append(userResource.password_last_used)
         for key in userResource.access_keys.all():
-            res = boto3.client('iam').get_access_key_last_used(AccessKeyId=key.id)
+            res = get_client('iam').get_access_key_last_used(AccessKeyId=key.id)
             d = res.get('AccessKeyLastUsed', {}).get('LastUsedDate')
             if isinstance(d, datetime.date):
                 allUsageDates.append(d)
@@ -50,7 +50,7 @@ def get_old_users(users, createdThreshold=60, lastUsedThreshold=120):
 
 def delete_user(user):
     print("Attempting to delete user {}".format(user['UserName']))
-    iamRes = boto3.resource('iam')
+    iamRes = get_resource('iam')
     userRes = iamRes.User(user['UserName'])
     try:
         login_profile = userRes.LoginProfile()
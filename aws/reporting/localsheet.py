@@ -0,0 +1,137 @@
+"""
+    Report tabs stored in a local sqlite database, used in
+    place of the spreadsheet to run the pipeline offline
+"""
+
+import os
+import re
+import json
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+from sheet import SheetEditor, sheet_strings
+
+logger = logging.getLogger(__name__)
+
+# sqlite database holding the tabs when SHEET_BACKEND is 'local'
+LOCAL_SHEET_PATH = os.environ.get('LOCAL_SHEET_PATH', './report.sqlite')
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+# tabs share the connection, writes run one transaction at a time
+_write_lock = threading.Lock()
+
+def _connect(path):
+    """ returns the connection to path shared by all tabs """
+    with _connections_lock:
+        if path not in _connections:
+            conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            # cells holds the json list of a sheet row, rows count from 1 like in sheets
+            conn.execute("""CREATE TABLE IF NOT EXISTS sheet_rows (
+                sheet TEXT, row INTEGER, cells TEXT, PRIMARY KEY (sheet, row))""")
+            _connections[path] = conn
+        return _connections[path]
+
+def _parse_cell(ref):
+    """ returns 1 based (row, column) of an A1 reference, None for a missing part """
+    match = re.match(r'^([A-Za-z]*)(\d*)$', ref)
+    if match is None:
+        raise Exception("invalid cell reference {}".format(ref))
+    letters, digits = match.groups()
+    column = None
+    if letters:
+        column = 0
+        for letter in letters.upper():
+            column = column * 26 + ord(letter) - 64
+    return (int(digits) if digits else None, column)
+
+def _trim(rows):
+    """ drops trailing empty cells and rows like the sheets api """
+    rows = [list(row) for row in rows]
+    for row in rows:
+        while row and row[-1] == '':
+            row.pop()
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+class LocalSheetEditor(SheetEditor):
+    """ tab stored in a sqlite database, with the same layout as the
+        spreadsheet: title rows, timestamp in A3, labels and data below
+    """
+    def __init__(self, sheet_name, title_rows=3, path=LOCAL_SHEET_PATH, key_fields=None):
+        super(LocalSheetEditor, self).__init__(sheet_name, title_rows, key_fields)
+        self.path = path
+        self.conn = _connect(path)
+
+    @contextmanager
+    def _transaction(self):
+        """ runs the writes of the block as one transaction under _write_lock """
+        with _write_lock:
+            self.conn.execute("BEGIN")
+            try:
+                yield
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def _rows(self, first_row, last_row=None):
+        """ returns rows first_row..last_row, empty rows in between included """
+        query = "SELECT row, cells FROM sheet_rows WHERE sheet = ? AND row >= ?"
+        params = [self.sheet_name, first_row]
+        if last_row is not None:
+            query += " AND row <= ?"
+            params.append(last_row)
+        rows = []
+        for row, cells in self.conn.execute(query + " ORDER BY row", params):
+            rows.extend([] for _ in range(row - first_row - len(rows)))
+            rows.append(json.loads(cells))
+        return rows
+
+    def _write_rows(self, first_row, rows):
+        self.conn.executemany("INSERT OR REPLACE INTO sheet_rows VALUES (?, ?, ?)",
+            [(self.sheet_name, first_row + i, json.dumps(sheet_strings(row))) for i, row in enumerate(rows)])
+
+    def _update_timestamp(self):
+        self._write_rows(3, self._timestamp_values())
+
+    def read_spreadsheet(self, indexField=None):
+        return self.from_sheet_data(_trim(self._rows(self.title_rows+1)), indexField)
+
+    def read_custom(self, start, end, indexField=None):
+        start_row, start_column = _parse_cell(start)
+        end_row, end_column = _parse_cell(end)
+        rows = self._rows(start_row or 1, end_row)
+        first = (start_column or 1) - 1
+        return _trim([row[first:end_column] for row in rows])
+
+    def save_data_to_sheet(self, rows, keep_missing=False):
+        data = self.to_sheet_data(rows)
+        with self._transaction():
+            if keep_missing:
+                data = self._keep_missing_rows(data, _trim(self._rows(self.title_rows+1)))
+            self.conn.execute("DELETE FROM sheet_rows WHERE sheet = ? AND row > ?",
+                (self.sheet_name, self.title_rows))
+            self._update_timestamp()
+            self._write_rows(self.title_rows+1, data)
+        logger.info("{} Saved {} rows to {}".format(self.sheet_name, len(data), self.path))
+        return []
+
+    def append_data_to_sheet(self, rows):
+        data = self.to_sheet_data(rows, skip_labels=True)
+        with self._transaction():
+            last_row = self.conn.execute("SELECT MAX(row) FROM sheet_rows WHERE sheet = ? AND row > ?",
+                (self.sheet_name, self.title_rows)).fetchone()[0]
+            self._update_timestamp()
+            self._write_rows(max(last_row or 0, self.title_rows+1) + 1, data)
+        return []
+
+    def clear_previous_data(self):
+        with self._transaction():
+            self.conn.execute("DELETE FROM sheet_rows WHERE sheet = ? AND row > ?",
+                (self.sheet_name, self.title_rows))
+        return []
@@ -1,19 +1,28 @@
 import logging
 import os
 import re
-from datetime import datetime, timedelta
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 
 import pytz
 
 from cloudformation import delete_stacks
-from ec2 import get_all_instances, reformat_instance_data, \
+from common import compile_keys, save_to_file
+from costs import price_resources
+from ec2 import iter_all_instances, reformat_instance_data, \
     get_all_eips, reformat_eips_data, get_all_unused_volumes, \
-    delete_volume, delete_eip, terminate_instance, EC2_KEYS
-from elbs import get_all_elbs, reformat_elbs_data, delete_classic_elb
+    delete_volume, delete_eip, terminate_instances_in_region, EC2_KEYS, INSTANCE_COLUMNS
+from elbs import iter_all_elbs, reformat_elbs_data, delete_classic_elb, ELB_COLUMNS
 from emailer import Emailer
-from s3 import get_all_buckets, reformat_buckets_data
-from sheet import GoogleSheetEditor
-from vpc import get_all_vpcs, delete_orphan_vpcs
+from pricing import get_price_cache
+from s3 import get_all_buckets, reformat_buckets_data, add_bucket_sizes
+from localsheet import LocalSheetEditor
+from sinks import open_sinks, open_stream, stream_rows
+from sheet import GoogleSheetEditor, SheetWriteBatch, get_sheet_client, to_cell
+from snapshot import open_snapshot, SNAPSHOT_PATH, SNAPSHOT_TABLES
+from vpc import get_all_vpcs, delete_orphan_vpcs, get_all_nat_gateways, flatten_vpcs, group_vpcs
+
+logger = logging.getLogger(__name__)
 
 # number of days to qualify an instance as old
 OLD_INSTANCE_THRESHOLD = 30
@@ -21,8 +30,56 @@ OLD_INSTANCE_THRESHOLD = 30
 # number of days to qualify a bucket as old
 OLD_BUCKETS_THRESHOLD = 60
 
-def prepare_old_instances_data(all_instances_sheet, old_instances_sheet, tdelta=timedelta(days=0)):
-    instances = all_instances_sheet.read_spreadsheet()
+# 'google' keeps the report in the spreadsheet GOOGLE_SHEET_ID,
+# 'local' in the sqlite database LOCAL_SHEET_PATH
+SHEET_BACKEND = os.environ.get('SHEET_BACKEND', 'google')
+
+def open_sheet(sheet_name, batch=None, key_fields=None):
+    """ returns the editor of a report tab for SHEET_BACKEND """
+    if SHEET_BACKEND == 'local':
+        return LocalSheetEditor(sheet_name, key_fields=key_fields)
+    return GoogleSheetEditor(batch.sheet_id, sheet_name, batch=batch, key_fields=key_fields)
+
+def save_snapshot(instances, tables=SNAPSHOT_TABLES):
+    """ writes the instances and, when listed in tables, vpcs of all regions """
+    tables = [t.strip() for t in tables.split(',')]
+    try:
+        snapshot_tables = {'instances': instances}
+        if 'vpcs' in tables:
+            snapshot_tables['vpcs'] = flatten_vpcs(get_all_vpcs())
+        save_to_file(snapshot_tables, SNAPSHOT_PATH)
+    except Exception as e:
+        logger.info("Error writing snapshot {}".format(SNAPSHOT_PATH))
+        logger.error(str(e))
+
+@contextmanager
+def report_snapshot():
+    """ yields the snapshot of the last report, None when there is no
+        fresh one, rows read from it are only valid inside the block
+    """
+    snapshot = open_snapshot()
+    try:
+        yield snapshot
+    finally:
+        if snapshot is not None:
+            snapshot.close()
+
+def load_snapshot_table(snapshot, name, convert=None):
+    """ returns rows of a table of the snapshot, values are read from the
+        mapped file when accessed, None when the table is not available
+    """
+    if snapshot is None or name not in snapshot.tables:
+        return None
+    return snapshot.table(name).rows(convert)
+
+def load_snapshot_instances(snapshot):
+    """ returns instances of the last report the way the all instances sheet shows them """
+    return load_snapshot_table(snapshot, 'instances', to_cell)
+
+def prepare_old_instances_data(all_instances_sheet, old_instances_sheet, tdelta=timedelta(days=0), instances=None):
+    """ instances (iterable): rows of the all instances sheet, streamed from it when not given """
+    if instances is None:
+        instances = all_instances_sheet.iter_rows()
     existing_old_instances = old_instances_sheet.read_spreadsheet(indexField='InstanceId')
     old_instances = []
     for instance in instances:
@@ -34,12 +91,8 @@ def prepare_old_instances_data(all_instances_sheet, old_instances_sheet, tdelta=
             old_instances.append(instance)
     if not old_instances:
         dummy_old_instance = {}
-        for key in EC2_KEYS:
-            split_keys = key.split('.')
-            if len(split_keys) == 1:
-                dummy_old_instance[key] = ''
-            else:
-                dummy_old_instance[split_keys[-1]] = ''
+        for column in compile_keys(EC2_KEYS).columns:
+            dummy_old_instance[column] = ''
         dummy_old_instance['TotalBill'] = ''
         dummy_old_instance['Cost Per Day'] = ''
         dummy_old_instance['Saved'] = ''
@@ -48,7 +101,7 @@ def prepare_old_instances_data(all_instances_sheet, old_instances_sheet, tdelta=
     return old_instances
 
 def prepare_old_s3_buckets_data(all_s3_buckets_sheet, old_s3_buckets_sheet):
-    all_buckets = all_s3_buckets_sheet.read_spreadsheet()
+    all_buckets = all_s3_buckets_sheet.iter_rows()
     existin_old_buckets = old_s3_buckets_sheet.read_spreadsheet(indexField='Name')
     old_buckets = []
     for bucket in all_buckets:
@@ -59,24 +112,23 @@ def prepare_old_s3_buckets_data(all_s3_buckets_sheet, old_s3_buckets_sheet):
             old_buckets.append(bucket)
     return old_buckets
 
-def terminate_instances(old_instances_sheet, all_instances_sheet):
-    old_instances = prepare_old_instances_data(all_instances_sheet, old_instances_sheet, timedelta(days=-4))
-    instance_ids = []
+def terminate_instances(old_instances_sheet, all_instances_sheet, instances=None):
+    old_instances = prepare_old_instances_data(all_instances_sheet, old_instances_sheet, timedelta(days=-4), instances)
+    instance_ids_per_region = {}
     deleted_instances = 0
     for inst in old_instances:
-        if 'save' not in inst['Saved'].lower():
+        if 'save' not in inst['Saved'].lower() and inst['InstanceId'] != '':
             instance_id = inst['InstanceId']
             instance_region = re.sub(r'(\w+)-(\w+)-(\d)\w+', r"\g<1>-\g<2>-\g<3>", inst["AvailabilityZone"])
-            instance_ids.append([instance_id, instance_region])
-    for inst in instance_ids:
-        response = terminate_instance(inst[0], inst[1])
-        if response.get('ResponseMetadata', {}).get('HTTPStatusCode', 500) == 200:
-            deleted_instances += 1
-    return deleted_instances       
+            instance_ids_per_region.setdefault(instance_region, []).append(instance_id)
+    for region, instance_ids in instance_ids_per_region.items():
+        deleted_instances += len(terminate_instances_in_region(instance_ids, region))
+    return deleted_instances
 
-def delete_unused_volumes():
+def delete_unused_volumes(vols=None):
     deleted_vols = 0
-    vols = get_all_unused_volumes()
+    if vols is None:
+        vols = get_all_unused_volumes()
     for vol in vols:
         response = delete_volume(vol['VolumeId'], vol['Region'])
         if response.get('ResponseMetadata', {}).get('HTTPStatusCode', 500) == 200:
@@ -102,13 +154,18 @@ def delete_unassigned_eips(eips):
     return deleted_eips
 
 def delete_vpcs():
-    vpcs = get_all_vpcs()
-    deleted_vpcs = delete_orphan_vpcs(vpcs)
+    with report_snapshot() as snapshot:
+        vpcs = load_snapshot_table(snapshot, 'vpcs')
+        if vpcs is None:
+            vpcs = get_all_vpcs()
+        else:
+            vpcs = group_vpcs(vpcs)
+        deleted_vpcs = delete_orphan_vpcs(vpcs)
     return deleted_vpcs
 
-def get_old_instances_email_summary(oldInstancesSheet, allInstancesSheet, summarySheet):
+def get_old_instances_email_summary(oldInstancesSheet, allInstancesSheet, summarySheet, instances=None):
     sheet_link = os.environ['SHEET_LINK']
-    old_instances = prepare_old_instances_data(allInstancesSheet, oldInstancesSheet)
+    old_instances = prepare_old_instances_data(allInstancesSheet, oldInstancesSheet, instances=instances)
     if summarySheet is not None:
         try:
             total_ec2_deleted = summarySheet.read_custom('J1', 'J1')[0][0]
@@ -175,7 +232,6 @@ def start(argument):
     logging.getLogger('botocore').setLevel(logging.ERROR)
     logging.getLogger('googleapiclient').setLevel(logging.ERROR)
 
-    sheet_id = os.environ['GOOGLE_SHEET_ID']
     allInstancesSheetName = os.environ['SHEET_ALL_INSTANCES']
     oldInstancesSheetName = os.environ['SHEET_OLD_INSTANCES']
     allEipsSheetName = os.environ['SHEET_ALL_EIPS']
@@ -184,13 +240,23 @@ def start(argument):
     oldS3SheetName = os.environ['SHEET_OLD_BUCKETS']
     summarySheetName = os.environ['SHEET_SUMMARY']
 
-    allInstancesSheet = GoogleSheetEditor(sheet_id, allInstancesSheetName)
-    oldInstancesSheet = GoogleSheetEditor(sheet_id, oldInstancesSheetName)
-    allEipsSheet = GoogleSheetEditor(sheet_id, allEipsSheetName)
-    allElbsSheet = GoogleSheetEditor(sheet_id, allElbsSheetName)
-    allS3Sheet = GoogleSheetEditor(sheet_id, allS3SheetName)
-    oldS3Sheet = GoogleSheetEditor(sheet_id, oldS3SheetName)
-    summarySheet = GoogleSheetEditor(sheet_id, summarySheetName)
+    batch = None
+    if SHEET_BACKEND != 'local':
+        # writes of all tabs are sent together, at the end of the run or
+        # once SHEET_CHUNK_ROWS rows are queued
+        batch = SheetWriteBatch(get_sheet_client(), os.environ['GOOGLE_SHEET_ID'])
+        # the client outlives the run in a warm Lambda container, tabs may
+        # have been resized or renamed by hand since its last invocation
+        batch.client.invalidate_properties(batch.sheet_id)
+    allInstancesSheet = open_sheet(allInstancesSheetName, batch, key_fields='InstanceId')
+    oldInstancesSheet = open_sheet(oldInstancesSheetName, batch, key_fields='InstanceId')
+    allEipsSheet = open_sheet(allEipsSheetName, batch, key_fields='AllocationId')
+    allElbsSheet = open_sheet(allElbsSheetName, batch, key_fields=('LoadBalancerName', 'Region'))
+    allS3Sheet = open_sheet(allS3SheetName, batch, key_fields='Name')
+    oldS3Sheet = open_sheet(oldS3SheetName, batch, key_fields='Name')
+    summarySheet = open_sheet(summarySheetName, batch)
+    # files written in addition to the sheet, see REPORT_SINKS
+    sinks = open_sinks()
 
     summaryRow = {
         'Date': '',
@@ -200,79 +266,127 @@ def start(argument):
         'Volumes': '',
         'VPC Cleanup': '',
         'EC2 Cleanup': '',
+        'Volumes Daily Cost': '',
+        'EIPs Daily Cost': '',
+        # column J stays empty, J1 holds the total read by get_old_instances_email_summary
+        'Total EC2 Deleted': '',
+        'NAT Gateways Daily Cost': '',
+        'S3 Daily Cost': '',
     }
     now = datetime.now(pytz.timezone('US/Eastern')).strftime("%H:%M:%S %B %d, %Y")
     summaryRow['Date'] = now
 
     skip_summary = False
 
-    if argument == 'report':
-        # update all instances sheet
-        instances = get_all_instances()
-        instances = reformat_instance_data(instances)
-        instances_daily_bill = 0.0
-        for instance in instances:
-            instances_daily_bill += float(re.sub(r'\$', '', instance['Cost Per Day']))
-        summaryRow['EC2 Daily Cost'] = "${}".format(str(instances_daily_bill))
-        print(allInstancesSheet.save_data_to_sheet(instances))
-        # update old instance sheet
-        instances = prepare_old_instances_data(allInstancesSheet, oldInstancesSheet)
-        print(oldInstancesSheet.save_data_to_sheet(instances))
-
-        # update eips sheet
-        eips = get_all_eips()
-        eips = reformat_eips_data(eips)
-        print(allEipsSheet.save_data_to_sheet(eips))
-
-        # update elbs sheet
-        elbs = get_all_elbs()
-        elbs = reformat_elbs_data(elbs)
-        numberOfElbsDeleted = delete_unassigned_elbs(elbs)
-        summaryRow['ELBs'] = 'Deleted {} elbs'.format(numberOfElbsDeleted)
-        elbs_daily_bill = 0.0
-        for elb in elbs:
-            elbs_daily_bill += float(re.sub(r'\$', '', elb['CostPerDay']))
-        summaryRow['ELBs Daily Cost'] = "${}".format(str(elbs_daily_bill))
-        print(allElbsSheet.save_data_to_sheet(elbs))
-
-        # delete old volumes
-        numberOfVolumesDeleted = delete_unused_volumes()
-        summaryRow['Volumes'] = 'Deleted {} volumes'.format(numberOfVolumesDeleted)
-
-        # update all buckets sheet
-        buckets = get_all_buckets()
-        buckets = reformat_buckets_data(buckets)
-        print(allS3Sheet.save_data_to_sheet(buckets))
-        # update old buckets sheet
-        buckets = prepare_old_s3_buckets_data(allS3Sheet, oldS3Sheet)
-        print(oldS3Sheet.save_data_to_sheet(buckets))
-
-    elif argument == 'purge_instances':
-        numberOfInstancesDeleted = terminate_instances(oldInstancesSheet, allInstancesSheet)
-        summaryRow['EC2 Cleanup'] = 'Deleted {} instances'.format(numberOfInstancesDeleted)
-        delete_stacks()
-
-    elif argument == 'generate_ec2_deletion_summary':
-        summaryEmail = get_old_instances_email_summary(oldInstancesSheet, allInstancesSheet, summarySheet)
-        print("SummaryEmail", summaryEmail)
-        if summaryEmail is not None:
-            smtp_addr = os.environ['SMTP_ADDR']
-            smtp_username = os.environ['SMTP_USERNAME']
-            smtp_password = os.environ['SMTP_PASSWORD']
-            smtp_sender = os.environ['SMTP_SENDER']
-            smtp_receivers = os.environ['SMTP_RECEIVERS'].split(',')
-            emailer = Emailer(smtp_addr, smtp_username, smtp_password)
-            emailer.send_email(smtp_sender, smtp_receivers, 'AWS Cleanup Notification', summaryEmail)
-        skip_summary = True
-
-    elif argument == 'purge_vpcs':
-        numberOfVpcsDeleted = delete_vpcs()
-        summaryRow['VPC Cleanup'] = 'Deleted {} vpcs'.format(numberOfVpcsDeleted)
-        numberOfEipsDeleted = delete_unassigned_eips(get_all_eips())
-        summaryRow['EC2 Cleanup'] = 'Deleted {} eips'.format(numberOfEipsDeleted)
-    else:
-        pass
-
-    if not skip_summary:
-        summarySheet.append_data_to_sheet([summaryRow])
+    try:
+        if argument == 'report':
+            # regions which could not be swept, the sheets keep the rows
+            # of resources missing from a partial inventory
+            failed_regions = {}
+            # regions are billed against the same time, the price cache
+            # is written once at the end of the run
+            utc_now = datetime.now(tz=timezone.utc)
+            # update all instances sheet
+            # regions are priced and written to the sinks as they are swept
+            instances = []
+            with open_stream(sinks, 'instances', INSTANCE_COLUMNS) as stream:
+                for region_instances in iter_all_instances(failed_regions):
+                    stream.extend(reformat_instance_data(region_instances, utc_now, flush=False))
+                    instances.extend(region_instances)
+            summaryRow['EC2 Daily Cost'] = sum(instance['Cost Per Day'] for instance in instances)
+            if failed_regions:
+                logger.error("Instances of {} missing, snapshot not written".format(', '.join(failed_regions)))
+            else:
+                # inventory read by the purge commands instead of the sheet / AWS
+                save_snapshot(instances)
+            print(allInstancesSheet.save_data_to_sheet(instances, keep_missing=bool(failed_regions)))
+            # update old instance sheet
+            instances = prepare_old_instances_data(allInstancesSheet, oldInstancesSheet)
+            print(oldInstancesSheet.save_data_to_sheet(instances, keep_missing=bool(failed_regions)))
+
+            # price remaining resources in one batch
+            eips = get_all_eips(failed_regions)
+            eips = reformat_eips_data(eips)
+            volumes = get_all_unused_volumes()
+            nat_gateways = get_all_nat_gateways()
+            buckets = get_all_buckets()
+            buckets = add_bucket_sizes(reformat_buckets_data(buckets))
+            resources_daily_bill = price_resources({
+                'eips': eips,
+                'volumes': volumes,
+                'nat_gateways': nat_gateways,
+                'buckets': buckets,
+            })
+            summaryRow['Volumes Daily Cost'] = resources_daily_bill['volumes']
+            summaryRow['EIPs Daily Cost'] = resources_daily_bill['eips']
+            summaryRow['NAT Gateways Daily Cost'] = resources_daily_bill['nat_gateways']
+            summaryRow['S3 Daily Cost'] = resources_daily_bill['buckets']
+            stream_rows(sinks, 'eips', eips)
+            stream_rows(sinks, 'volumes', volumes)
+            stream_rows(sinks, 'nat_gateways', nat_gateways)
+            stream_rows(sinks, 'buckets', buckets)
+
+            # update eips sheet
+            print(allEipsSheet.save_data_to_sheet(eips, keep_missing=bool(failed_regions)))
+
+            # update elbs sheet
+            elbs = []
+            with open_stream(sinks, 'elbs', ELB_COLUMNS) as stream:
+                for region_elbs in iter_all_elbs(failed_regions):
+                    stream.extend(reformat_elbs_data(region_elbs, utc_now, flush=False))
+                    elbs.extend(region_elbs)
+            numberOfElbsDeleted = delete_unassigned_elbs(elbs)
+            summaryRow['ELBs'] = 'Deleted {} elbs'.format(numberOfElbsDeleted)
+            summaryRow['ELBs Daily Cost'] = sum(elb['CostPerDay'] for elb in elbs)
+            print(allElbsSheet.save_data_to_sheet(elbs, keep_missing=bool(failed_regions)))
+
+            # delete old volumes
+            numberOfVolumesDeleted = delete_unused_volumes(volumes)
+            summaryRow['Volumes'] = 'Deleted {} volumes'.format(numberOfVolumesDeleted)
+
+            # update all buckets sheet
+            print(allS3Sheet.save_data_to_sheet(buckets))
+            # update old buckets sheet
+            buckets = prepare_old_s3_buckets_data(allS3Sheet, oldS3Sheet)
+            print(oldS3Sheet.save_data_to_sheet(buckets))
+
+        elif argument == 'purge_instances':
+            with report_snapshot() as snapshot:
+                numberOfInstancesDeleted = terminate_instances(oldInstancesSheet, allInstancesSheet,
+                                                load_snapshot_instances(snapshot))
+            summaryRow['EC2 Cleanup'] = 'Deleted {} instances'.format(numberOfInstancesDeleted)
+            delete_stacks()
+
+        elif argument == 'generate_ec2_deletion_summary':
+            with report_snapshot() as snapshot:
+                summaryEmail = get_old_instances_email_summary(oldInstancesSheet, allInstancesSheet, summarySheet,
+                                                load_snapshot_instances(snapshot))
+            print("SummaryEmail", summaryEmail)
+            if summaryEmail is not None:
+                smtp_addr = os.environ['SMTP_ADDR']
+                smtp_username = os.environ['SMTP_USERNAME']
+                smtp_password = os.environ['SMTP_PASSWORD']
+                smtp_sender = os.environ['SMTP_SENDER']
+                smtp_receivers = os.environ['SMTP_RECEIVERS'].split(',')
+                emailer = Emailer(smtp_addr, smtp_username, smtp_password)
+                emailer.send_email(smtp_sender, smtp_receivers, 'AWS Cleanup Notification', summaryEmail)
+            skip_summary = True
+
+        elif argument == 'purge_vpcs':
+            numberOfVpcsDeleted = delete_vpcs()
+            summaryRow['VPC Cleanup'] = 'Deleted {} vpcs'.format(numberOfVpcsDeleted)
+            numberOfEipsDeleted = delete_unassigned_eips(get_all_eips())
+            summaryRow['EC2 Cleanup'] = 'Deleted {} eips'.format(numberOfEipsDeleted)
+        else:
+            pass
+
+        if not skip_summary:
+            summarySheet.append_data_to_sheet([summaryRow])
+    finally:
+        # tabs queued before a failure are still written
+        if batch is not None:
+            print(batch.flush())
+            logger.info("Sheets requests {}".format(batch.client.scheduler.stats()))
+        get_price_cache().flush()
+    logger.info("Price cache {}".format(get_price_cache().stats()))
 
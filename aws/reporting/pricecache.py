@@ -0,0 +1,145 @@
+"""
+    Persistent price cache shared across runs
+    and Lambda invocations
+"""
+
+import os
+import json
+import atexit
+import time
+import sqlite3
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# .json paths use a json file, anything else a sqlite database,
+# an empty value disables the persistent cache
+PRICING_CACHE_PATH = os.environ.get('PRICING_CACHE_PATH',
+    os.path.join(tempfile.gettempdir(), 'aws-reporting-prices.sqlite'))
+
+# seconds after which cached prices are fetched again
+PRICING_CACHE_TTL = int(os.environ.get('PRICING_CACHE_TTL', str(7 * 24 * 3600)))
+
+# least recently used prices are evicted past this many entries
+PRICING_CACHE_MAX_ENTRIES = int(os.environ.get('PRICING_CACHE_MAX_ENTRIES', '10000'))
+
+def _key_to_str(key):
+    return '|'.join(str(k) for k in key)
+
+class PriceCache(object):
+    """ base price cache, keeps hit / miss counters and stores nothing
+    """
+    def __init__(self, ttl=PRICING_CACHE_TTL, max_entries=PRICING_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ returns cached price of key, None when missing or expired """
+        with self._lock:
+            price = self._get(_key_to_str(key), time.time())
+            if price is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return price
+
+    def set(self, key, price):
+        with self._lock:
+            self._set(_key_to_str(key), price, time.time())
+
+    def flush(self):
+        """ persists pending updates """
+        with self._lock:
+            self._flush()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _get(self, key, now):
+        return None
+
+    def _set(self, key, price, now):
+        pass
+
+    def _flush(self):
+        pass
+
+class SqlitePriceCache(PriceCache):
+    """ price cache stored in a sqlite database """
+    def __init__(self, path, **kwargs):
+        super(SqlitePriceCache, self).__init__(**kwargs)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS prices (
+            key TEXT PRIMARY KEY, price REAL, stored_at REAL, accessed_at REAL)""")
+
+    def _get(self, key, now):
+        row = self.conn.execute("SELECT price, stored_at FROM prices WHERE key = ?", (key,)).fetchone()
+        if row is None or now - row[1] > self.ttl:
+            return None
+        self.conn.execute("UPDATE prices SET accessed_at = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def _set(self, key, price, now):
+        self.conn.execute("INSERT OR REPLACE INTO prices VALUES (?, ?, ?, ?)", (key, price, now, now))
+        self.conn.execute("""DELETE FROM prices WHERE key NOT IN (
+            SELECT key FROM prices ORDER BY accessed_at DESC LIMIT ?)""", (self.max_entries,))
+
+class JsonFilePriceCache(PriceCache):
+    """ price cache stored in a json file, updates are kept in memory
+        and the file is rewritten once per flush
+    """
+    def __init__(self, path, **kwargs):
+        super(JsonFilePriceCache, self).__init__(**kwargs)
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        if os.path.exists(path):
+            with open(path) as fp:
+                self.entries = json.load(fp)
+
+    def _get(self, key, now):
+        entry = self.entries.get(key)
+        if entry is None or now - entry['stored_at'] > self.ttl:
+            return None
+        entry['accessed_at'] = now
+        return entry['price']
+
+    def _set(self, key, price, now):
+        self.entries[key] = {'price': price, 'stored_at': now, 'accessed_at': now}
+        if len(self.entries) > self.max_entries:
+            evicted = sorted(self.entries, key=lambda k: self.entries[k]['accessed_at'])
+            for k in evicted[:len(self.entries) - self.max_entries]:
+                del self.entries[k]
+        self.dirty = True
+
+    def _flush(self):
+        if not self.dirty:
+            return
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as fp:
+            json.dump(self.entries, fp)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+def open_price_cache(path=PRICING_CACHE_PATH):
+    """ opens the persistent cache at path, falls back to a
+        counting-only cache when the path is empty or unusable
+    """
+    try:
+        if not path:
+            return PriceCache()
+        if path.endswith('.json'):
+            cache = JsonFilePriceCache(path)
+            # prefetches flush their batch, this catches lookups outside of them
+            atexit.register(cache.flush)
+            return cache
+        return SqlitePriceCache(path)
+    except Exception as e:
+        logger.info("Error opening price cache {}".format(path))
+        logger.error(str(e))
+        return PriceCache()
@@ -0,0 +1,274 @@
+"""
+    Offline index of on-demand prices built from
+    AWS price list offer files
+"""
+
+import os
+import csv
+import sys
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# offer files (json / csv) or saved indexes loaded at first lookup,
+# separated by os.pathsep
+PRICING_CATALOG_PATH = os.environ.get('PRICING_CATALOG_PATH', '')
+
+CATALOG_FORMAT_VERSION = 1
+
+SERVICE_EC2 = 'AmazonEC2'
+SERVICE_ELB = 'AWSELB'
+SERVICE_S3 = 'AmazonS3'
+
+# products of resources other than instances and elbs, indexed
+# as (service, product, region, '', '')
+PRODUCT_NAT_GATEWAY = 'natgateway'
+PRODUCT_IDLE_IP = 'eip:idle'
+PRODUCT_EBS_PREFIX = 'ebs:'
+PRODUCT_S3_PREFIX = 's3:'
+
+# location names used by offer files without regionCode attribute
+REGION_NAMES = {
+    'us-east-1': 'US East (N. Virginia)',
+    'us-east-2': 'US East (Ohio)',
+    'us-west-1': 'US West (N. California)',
+    'us-west-2': 'US West (Oregon)',
+    'af-south-1': 'Africa (Cape Town)',
+    'ap-east-1': 'Asia Pacific (Hong Kong)',
+    'ap-south-1': 'Asia Pacific (Mumbai)',
+    'ap-northeast-1': 'Asia Pacific (Tokyo)',
+    'ap-northeast-2': 'Asia Pacific (Seoul)',
+    'ap-northeast-3': 'Asia Pacific (Osaka)',
+    'ap-southeast-1': 'Asia Pacific (Singapore)',
+    'ap-southeast-2': 'Asia Pacific (Sydney)',
+    'ap-southeast-3': 'Asia Pacific (Jakarta)',
+    'ca-central-1': 'Canada (Central)',
+    'eu-central-1': 'EU (Frankfurt)',
+    'eu-west-1': 'EU (Ireland)',
+    'eu-west-2': 'EU (London)',
+    'eu-west-3': 'EU (Paris)',
+    'eu-north-1': 'EU (Stockholm)',
+    'eu-south-1': 'EU (Milan)',
+    'me-south-1': 'Middle East (Bahrain)',
+    'sa-east-1': 'South America (Sao Paulo)',
+}
+
+_LOCATION_REGIONS = dict((v, k) for k, v in REGION_NAMES.items())
+
+# elb operation attribute -> elb type used by the collectors
+ELB_OPERATIONS = {
+    'LoadBalancing': 'classic',
+    'LoadBalancing:Application': 'application',
+    'LoadBalancing:Network': 'network',
+}
+
+def _normalize(name):
+    """ json attributes are camelCase, csv columns are display
+        names, both are reduced to lower case alphanumerics
+    """
+    return ''.join(c for c in name.lower() if c.isalnum())
+
+def _region_of(attributes):
+    region = attributes.get('regioncode', '')
+    if not region:
+        region = _LOCATION_REGIONS.get(attributes.get('location', ''), '')
+    return region
+
+def price_key(service, attributes):
+    """ returns index key for a product, None for products we never price
+
+        attributes (dict): product attributes with normalized names
+    """
+    region = _region_of(attributes)
+    if not region:
+        return None
+    usage_type = attributes.get('usagetype', '')
+    family = attributes.get('productfamily', '')
+    if service == SERVICE_EC2 and family == 'Storage':
+        # ebs volumes, priced per GB-month
+        if 'EBS:VolumeUsage' not in usage_type or not attributes.get('volumeapiname'):
+            return None
+        return (service, PRODUCT_EBS_PREFIX + attributes['volumeapiname'], region, '', '')
+    if service == SERVICE_EC2 and family == 'NAT Gateway':
+        if not usage_type.endswith('NatGateway-Hours'):
+            return None
+        return (service, PRODUCT_NAT_GATEWAY, region, '', '')
+    if service == SERVICE_EC2 and family == 'IP Address':
+        if not usage_type.endswith('IdleAddress'):
+            return None
+        return (service, PRODUCT_IDLE_IP, region, '', '')
+    if service == SERVICE_S3:
+        # standard storage, priced per GB-month
+        if family != 'Storage' or not usage_type.endswith('TimedStorage-ByteHrs'):
+            return None
+        return (service, PRODUCT_S3_PREFIX + attributes.get('volumetype', ''), region, '', '')
+    if service == SERVICE_EC2:
+        if 'BoxUsage' not in usage_type:
+            return None
+        if attributes.get('preinstalledsw', 'NA') != 'NA':
+            return None
+        if attributes.get('capacitystatus', 'Used') != 'Used':
+            return None
+        return (service, attributes.get('instancetype', ''), region,
+                attributes.get('operatingsystem', ''), attributes.get('tenancy', '').lower())
+    if service == SERVICE_ELB:
+        if not usage_type.endswith('LoadBalancerUsage'):
+            return None
+        elb_type = ELB_OPERATIONS.get(attributes.get('operation', ''))
+        if elb_type is None:
+            return None
+        return (service, elb_type, region, '', '')
+    return None
+
+def _on_demand_price(terms):
+    """ returns USD price of the first on-demand term, tiered
+        prices resolve to their most expensive tier, which
+        overestimates usage past the first tier
+    """
+    for term in terms.values():
+        prices = [float(dimension['pricePerUnit']['USD'])
+                    for dimension in term.get('priceDimensions', {}).values()]
+        if prices:
+            return max(prices)
+    return None
+
+class PriceCatalog(object):
+    """ in-memory index of on-demand prices keyed by
+        (service, instanceType, region, OS, tenancy)
+
+        elbs use the elb type as instanceType, other resources one of the
+        PRODUCT_ names, both leave OS and tenancy empty
+    """
+    def __init__(self):
+        self.prices = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.prices)
+
+    def get(self, service, product, region, os_name='', tenancy=''):
+        return self.prices.get((service, product, region, os_name, tenancy.lower()))
+
+    def add(self, key, price):
+        if key is not None and price is not None:
+            with self._lock:
+                self.prices[key] = price
+
+    def add_product(self, service, product, terms):
+        """ indexes a single offer file / price list product
+
+            product (dict): product with 'attributes'
+            terms (dict): on-demand terms of the product
+        """
+        attributes = dict((_normalize(k), v) for k, v in product.get('attributes', {}).items())
+        if 'productFamily' in product:
+            attributes['productfamily'] = product['productFamily']
+        key = price_key(service, attributes)
+        if key is None:
+            return None
+        price = _on_demand_price(terms)
+        self.add(key, price)
+        return key
+
+    def add_price_list(self, service, price_list):
+        """ indexes PriceList items returned by pricing get_products """
+        keys = []
+        for item in price_list:
+            if isinstance(item, str):
+                item = json.loads(item)
+            key = self.add_product(service, item.get('product', {}), item.get('terms', {}).get('OnDemand', {}))
+            if key is not None:
+                keys.append(key)
+        return keys
+
+    def load(self, path):
+        """ loads a json or csv offer file, or an index written by save() """
+        if path.endswith('.csv'):
+            self._load_csv(path)
+        else:
+            with open(path) as fp:
+                data = json.load(fp)
+            if 'prices' in data:
+                for entry in data['prices']:
+                    self.add(tuple(entry[:5]), float(entry[5]))
+            else:
+                self._load_offer(data)
+        logger.info("Loaded pricing catalog {}, {} prices indexed".format(path, len(self.prices)))
+
+    def _load_offer(self, offer):
+        service = offer.get('offerCode', '')
+        on_demand = offer.get('terms', {}).get('OnDemand', {})
+        for sku, product in offer.get('products', {}).items():
+            self.add_product(service, product, on_demand.get(sku, {}))
+
+    def _load_csv(self, path):
+        with open(path, newline='') as fp:
+            service = ''
+            # metadata lines precede the header row
+            for line in csv.reader(fp):
+                if line and line[0] == 'OfferCode':
+                    service = line[1]
+                if line and line[0] == 'SKU':
+                    header = [_normalize(column) for column in line]
+                    break
+            else:
+                return
+            prices = {}
+            for line in csv.reader(fp):
+                row = dict(zip(header, line))
+                if row.get('termtype') != 'OnDemand' or row.get('currency', 'USD') != 'USD':
+                    continue
+                key = price_key(service or row.get('servicecode', ''), row)
+                if key is not None and row.get('priceperunit'):
+                    # tiers are separate rows, keep the most expensive one
+                    prices[key] = max(prices.get(key, 0.0), float(row['priceperunit']))
+            for key, price in prices.items():
+                self.add(key, price)
+
+    def save(self, path):
+        """ writes the compact index, loading it is much faster than the offer file """
+        with self._lock:
+            entries = [list(key) + [price] for key, price in sorted(self.prices.items())]
+        with open(path, 'w') as fp:
+            json.dump({'version': CATALOG_FORMAT_VERSION, 'prices': entries}, fp)
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+def get_catalog():
+    """ returns the process wide catalog, loading PRICING_CATALOG_PATH once
+    """
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                catalog = PriceCatalog()
+                for path in PRICING_CATALOG_PATH.split(os.pathsep):
+                    if not path:
+                        continue
+                    try:
+                        catalog.load(path)
+                    except Exception as e:
+                        logger.info("Error loading pricing catalog {}".format(path))
+                        logger.error(str(e))
+                _catalog = catalog
+    return _catalog
+
+if __name__ == "__main__":
+    if sys.argv[1] == '--refresh':
+        # python ./pricecatalog.py --refresh <regions|all> <index.json>
+        # queries the pricing api for the regions, on top of PRICING_CATALOG_PATH
+        from common import get_all_regions
+        from pricing import refresh_catalog
+        regions = get_all_regions() if sys.argv[2] == 'all' else sys.argv[2].split(',')
+        catalog = refresh_catalog(regions, sys.argv[3])
+        print("{} prices written to {}".format(len(catalog), sys.argv[3]))
+    else:
+        # python ./pricecatalog.py <index.json> <offer files...>
+        catalog = PriceCatalog()
+        for offer_path in sys.argv[2:]:
+            catalog.load(offer_path)
+        catalog.save(sys.argv[1])
+        print("{} prices written to {}".format(len(catalog), sys.argv[1]))
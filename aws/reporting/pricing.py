@@ -3,10 +3,35 @@
     costs using AWS Pricing api
 """
 
-import json
-import boto3
+import os
+import logging
+import threading
 from math import ceil
 from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from common import get_client
+from pricecache import open_price_cache
+from pricecatalog import get_catalog, SERVICE_EC2, SERVICE_ELB, SERVICE_S3, \
+    PRODUCT_NAT_GATEWAY, PRODUCT_IDLE_IP, PRODUCT_EBS_PREFIX, PRODUCT_S3_PREFIX
+
+logger = logging.getLogger(__name__)
+
+# number of missing prices resolved concurrently by prefetch_prices
+PRICING_PREFETCH_WORKERS = int(os.environ.get('PRICING_PREFETCH_WORKERS', '8'))
+
+# region priced when the region of a resource is unknown
+DEFAULT_PRICING_REGION = 'us-east-1'
+
+# attributes of the EC2 offers we price
+EC2_OPERATING_SYSTEM = 'Linux'
+EC2_TENANCY = 'shared'
+
+def _elb_type_key(elb_type):
+    """ elb type as indexed in the pricing catalog """
+    if elb_type in ('application', 'network'):
+        return elb_type
+    return 'classic'
 
 def _elb_operation_filter_map(elb_type):
     """ returns operation filter for ELB """
@@ -17,32 +42,6 @@ def _elb_operation_filter_map(elb_type):
     else:
         return 'LoadBalancing'
 
-def _ec2_usage_filter_map(instance_type):
-    """ returns usageType filter for EC2
-    """
-    return {
-        'us-east-1': 'BoxUsage:{}'.format(instance_type),
-        'us-east-2': 'USE2-BoxUsage:{}'.format(instance_type),
-        'us-west-1': 'USW1-BoxUsage:{}'.format(instance_type),
-        'us-west-2': 'USW2-BoxUsage:{}'.format(instance_type),
-        'eu-central-1': 'EUC1-BoxUsage:{}'.format(instance_type),
-        'eu-west-1': 'EUW1-BoxUsage:{}'.format(instance_type),
-        'eu-west-2': 'EUW2-BoxUsage:{}'.format(instance_type)
-    }
-
-def _region_filter_map():
-    """ returns pricing query filter for region field
-    """
-    return {
-        'us-east-1': 'US East (N. Virginia)',
-        'us-east-2': 'US East (Ohio)',
-        'us-west-1': 'US West (N. California)',
-        'us-west-2': 'US West (Oregon)',
-        'eu-central-1': 'EU (Frankfurt)',
-        'eu-west-1': 'EU (Ireland)',
-        'eu-west-2': 'EU (London)',
-    }
-
 def _ec2_pricing_filters(instance_type, region_code):
     """ returns a set of filters to match pricing info
         in specific region for given type  of instance
@@ -51,7 +50,7 @@ def _ec2_pricing_filters(instance_type, region_code):
         {
             'Field': 'operatingSystem',
             'Type': 'TERM_MATCH',
-            'Value': 'Linux',
+            'Value': EC2_OPERATING_SYSTEM,
         },
         {
             'Field': 'preInstalledSw',
@@ -64,19 +63,19 @@ def _ec2_pricing_filters(instance_type, region_code):
             'Value': instance_type
         },
         {
-            'Field': 'location',
+            'Field': 'regionCode',
             'Type': 'TERM_MATCH',
-            'Value': _region_filter_map().get(region_code, 'US East (N. Virginia)')
+            'Value': region_code
         },
         {
-            'Field': 'usageType',
+            'Field': 'capacitystatus',
             'Type': 'TERM_MATCH',
-            'Value': _ec2_usage_filter_map(instance_type).get(region_code, 'US East (N. Virginia)')
+            'Value': 'Used'
         },
         {
             'Field': 'tenancy',
             'Type': 'TERM_MATCH',
-            'Value': 'shared'
+            'Value': EC2_TENANCY
         }
     ]
 
@@ -86,9 +85,9 @@ def _elb_pricing_filters(elb_type, region_code):
     """
     return [
         {
-            'Field': 'location',
+            'Field': 'regionCode',
             'Type': 'TERM_MATCH',
-            'Value': _region_filter_map().get(region_code, 'US East (N. Virginia)')
+            'Value': region_code
         },
         {
             'Field': 'operation',
@@ -97,52 +96,249 @@ def _elb_pricing_filters(elb_type, region_code):
         }
     ]
 
+def _term_filters(region_code, **fields):
+    filters = [
+        {
+            'Field': 'regionCode',
+            'Type': 'TERM_MATCH',
+            'Value': region_code
+        }
+    ]
+    for field, value in fields.items():
+        filters.append({
+            'Field': field,
+            'Type': 'TERM_MATCH',
+            'Value': value
+        })
+    return filters
+
+def volume_price_query(volume_type, region_code):
+    """ returns (service, filters, catalog key) of the GB-month price of an ebs volume type """
+    return (SERVICE_EC2, _term_filters(region_code, productFamily='Storage', volumeApiName=volume_type),
+            (SERVICE_EC2, PRODUCT_EBS_PREFIX + volume_type, region_code, '', ''))
+
+def idle_eip_price_query(region_code):
+    """ returns (service, filters, catalog key) of the hourly price of an idle elastic ip """
+    return (SERVICE_EC2, _term_filters(region_code, productFamily='IP Address'),
+            (SERVICE_EC2, PRODUCT_IDLE_IP, region_code, '', ''))
+
+def nat_gateway_price_query(region_code):
+    """ returns (service, filters, catalog key) of the hourly price of a nat gateway """
+    return (SERVICE_EC2, _term_filters(region_code, productFamily='NAT Gateway'),
+            (SERVICE_EC2, PRODUCT_NAT_GATEWAY, region_code, '', ''))
+
+def s3_storage_price_query(region_code, volume_type='Standard'):
+    """ returns (service, filters, catalog key) of the GB-month price of s3 storage """
+    return (SERVICE_S3, _term_filters(region_code, productFamily='Storage', volumeType=volume_type),
+            (SERVICE_S3, PRODUCT_S3_PREFIX + volume_type, region_code, '', ''))
+
 # store pricing info in cache
 ec2_pricing_cache = {}
 elb_pricing_cache = {}
+# catalog key -> price of resources priced through price queries
+resource_pricing_cache = {}
+
+# persistent cache, opened on first lookup
+_price_cache = None
+_price_cache_lock = threading.Lock()
+
+def get_price_cache():
+    """ returns the process wide persistent cache, prefetch threads
+        may open it concurrently
+    """
+    global _price_cache
+    if _price_cache is None:
+        with _price_cache_lock:
+            if _price_cache is None:
+                _price_cache = open_price_cache()
+    return _price_cache
+
+def _refresh_prices(service_code, filters):
+    """ queries AWS pricing api and indexes all matching
+        products into the pricing catalog
+    """
+    client = get_client('pricing')
+    keys = []
+    paginator = client.get_paginator('get_products')
+    for page in paginator.paginate(ServiceCode=service_code, Filters=filters):
+        keys.extend(get_catalog().add_price_list(service_code, page['PriceList']))
+    return keys
 
-def _get_price(service_code, filters):
-    """ generic pricing info query builder
+def _get_price(service_code, filters, key):
+    """ looks up price in the persistent cache, then in the offline
+        catalog, the pricing api is only queried to refresh the catalog
+        for missing keys
     """
-    client = boto3.client('pricing')
-    response = client.get_products(ServiceCode=service_code, Filters=filters, MaxResults=1)
-    pricing_info = json.loads(response['PriceList'][0])['terms']['OnDemand']
-    pricing_dimensions = pricing_info[list(pricing_info.keys())[0]]['priceDimensions']
-    return float(pricing_dimensions[list(pricing_dimensions.keys())[0]]['pricePerUnit']['USD'])
+    price = get_price_cache().get(key)
+    if price is not None:
+        return price
+    price = get_catalog().get(*key)
+    if price is None:
+        _refresh_prices(service_code, filters)
+        price = get_catalog().get(*key)
+    if price is None:
+        raise Exception("No price found for {}".format(key))
+    get_price_cache().set(key, price)
+    return price
+
+def refresh_catalog(regions, path=None):
+    """ indexes all prices of the regions the report uses into
+        the catalog, writes the index to path when given
+    """
+    for region_code in regions:
+        _refresh_prices(SERVICE_EC2, [f for f in _ec2_pricing_filters('', region_code) if f['Field'] != 'instanceType'])
+        _refresh_prices(SERVICE_ELB, [f for f in _elb_pricing_filters('', region_code) if f['Field'] != 'operation'])
+        _refresh_prices(SERVICE_EC2, _term_filters(region_code, productFamily='Storage'))
+        for service_code, filters, _ in (idle_eip_price_query(region_code),
+                                         nat_gateway_price_query(region_code),
+                                         s3_storage_price_query(region_code)):
+            _refresh_prices(service_code, filters)
+    if path is not None:
+        get_catalog().save(path)
+    return get_catalog()
+
+def _resolve_instance_price(instance_type, region_code):
+    pricing_region = region_code or DEFAULT_PRICING_REGION
+    query_filters = _ec2_pricing_filters(instance_type, pricing_region)
+    return _get_price(SERVICE_EC2, query_filters,
+        (SERVICE_EC2, instance_type, pricing_region, EC2_OPERATING_SYSTEM, EC2_TENANCY))
+
+def _resolve_elb_price(elb_type, region_code):
+    pricing_region = region_code or DEFAULT_PRICING_REGION
+    query_filters = _elb_pricing_filters(elb_type, pricing_region)
+    return _get_price(SERVICE_ELB, query_filters,
+        (SERVICE_ELB, _elb_type_key(elb_type), pricing_region, '', ''))
 
 def get_price_for_instance(instance_type, region_code):
-    """ queries AWS pricing api to get pricing info for given instance
+    """ returns hourly price of given instance type from the pricing catalog
     """
     if instance_type in ec2_pricing_cache:
         if region_code in ec2_pricing_cache[instance_type]:
             return ec2_pricing_cache[instance_type][region_code]
-    query_filters = _ec2_pricing_filters(instance_type, region_code)
-    price_per_hour = _get_price('AmazonEC2', query_filters)
+    price_per_hour = _resolve_instance_price(instance_type, region_code)
     if instance_type not in ec2_pricing_cache:
         ec2_pricing_cache[instance_type] = {}
     ec2_pricing_cache[instance_type][region_code] = price_per_hour
     return price_per_hour
 
 def get_price_for_elb(elb_type, region_code):
-    """ queries AWS pricing api to get pricing info for given elb
+    """ returns hourly price of given elb type from the pricing catalog
     """
     if elb_type in elb_pricing_cache:
         if region_code in elb_pricing_cache[elb_type]:
             return elb_pricing_cache[elb_type][region_code]
-    query_filters = _elb_pricing_filters(elb_type, region_code)
-    price_per_hour = _get_price('AWSELB', query_filters)
+    price_per_hour = _resolve_elb_price(elb_type, region_code)
     if elb_type not in elb_pricing_cache:
         elb_pricing_cache[elb_type] = {}
     elb_pricing_cache[elb_type][region_code] = price_per_hour
     return price_per_hour
 
-def _calculate_bill(launch_time, price_per_hour):
+def _prefetch(memory_cache, resolve, pricing_keys, flush=True):
+    """ resolves all (type, region) keys missing from the in-memory
+        cache concurrently, results are stored from the calling thread
+    """
+    missing = sorted(set(key for key in pricing_keys
+                            if key[1] not in memory_cache.get(key[0], {})))
+    if not missing:
+        return
+    with ThreadPoolExecutor(max_workers=max(1, min(PRICING_PREFETCH_WORKERS, len(missing)))) as executor:
+        futures = [(key, executor.submit(resolve, *key)) for key in missing]
+        for key, future in futures:
+            try:
+                price_per_hour = future.result()
+            except Exception as e:
+                logger.info("Error fetching price for {} in {}".format(key[0], key[1]))
+                logger.error(str(e))
+                continue
+            if key[0] not in memory_cache:
+                memory_cache[key[0]] = {}
+            memory_cache[key[0]][key[1]] = price_per_hour
+    if flush:
+        get_price_cache().flush()
+
+def prefetch_prices(instance_keys=(), elb_keys=(), flush=True):
+    """ resolves every distinct pricing key in one concurrent batch
+        so that later lookups are served from memory
+
+        instance_keys (iterable): (instance type, region) pairs
+        elb_keys (iterable): (elb type, region) pairs
+        flush (bool): persist the price cache afterwards, callers pricing
+                        one batch after another flush it once at the end
+    """
+    _prefetch(ec2_pricing_cache, _resolve_instance_price, list(instance_keys), flush)
+    _prefetch(elb_pricing_cache, _resolve_elb_price, list(elb_keys), flush)
+
+def _calculate_bill(launch_time, price_per_hour, utc_now=None):
     utc_launch_time = launch_time.astimezone(timezone.utc)
-    utc_now = datetime.now(tz=timezone.utc)
+    if utc_now is None:
+        utc_now = datetime.now(tz=timezone.utc)
     total_bill = price_per_hour * ceil(float((utc_now - utc_launch_time).total_seconds()/3600))
     price_per_day = ceil(price_per_hour * 24)
     return total_bill, price_per_day
 
+def calculate_bills(prices_per_hour, launch_times, utc_now=None):
+    """ calculates cost-to-date for a batch of resources against a single 'now'
+
+        prices_per_hour (list): hourly price of each resource, None if unknown
+        launch_times (list): launch time of each resource
+
+        returns list of (price_per_hour, price_per_day, total_bill) tuples,
+        None for resources without price or launch time
+    """
+    if utc_now is None:
+        utc_now = datetime.now(tz=timezone.utc)
+    bills = []
+    for price_per_hour, launch_time in zip(prices_per_hour, launch_times):
+        if price_per_hour is None or not isinstance(launch_time, datetime):
+            bills.append(None)
+            continue
+        hours = ceil((utc_now - launch_time.astimezone(timezone.utc)).total_seconds()/3600)
+        bills.append((price_per_hour, ceil(price_per_hour * 24), price_per_hour * hours))
+    return bills
+
+def prefetch_resource_prices(queries):
+    """ resolves (service, filters, catalog key) price queries missing
+        from resource_pricing_cache in one concurrent batch
+    """
+    missing = {}
+    for service_code, filters, key in queries:
+        if key not in resource_pricing_cache:
+            missing[key] = (service_code, filters, key)
+    if not missing:
+        return
+    with ThreadPoolExecutor(max_workers=max(1, min(PRICING_PREFETCH_WORKERS, len(missing)))) as executor:
+        futures = [(key, executor.submit(_get_price, *query)) for key, query in missing.items()]
+        for key, future in futures:
+            try:
+                resource_pricing_cache[key] = future.result()
+            except Exception as e:
+                logger.info("Error fetching price for {}".format(key))
+                logger.error(str(e))
+    get_price_cache().flush()
+
+def get_cached_resource_price(key):
+    """ in-memory lookup of a prefetched resource price, None if unknown """
+    return resource_pricing_cache.get(key)
+
+def _cached_prices(memory_cache, pricing_keys):
+    """ in-memory lookups only, keys which could not be prefetched map to None
+    """
+    return [memory_cache.get(key[0], {}).get(key[1]) for key in pricing_keys]
+
+def calculate_bills_for_instances(instance_types, region_codes, launch_times, utc_now=None, flush=True):
+    """ batch version of calculate_bill_for_instance
+    """
+    pricing_keys = list(zip(instance_types, region_codes))
+    prefetch_prices(instance_keys=pricing_keys, flush=flush)
+    return calculate_bills(_cached_prices(ec2_pricing_cache, pricing_keys), launch_times, utc_now)
+
+def calculate_bills_for_elbs(elb_types, region_codes, launch_times, utc_now=None, flush=True):
+    """ batch version of calculate_bill_for_elb
+    """
+    pricing_keys = list(zip(elb_types, region_codes))
+    prefetch_prices(elb_keys=pricing_keys, flush=flush)
+    return calculate_bills(_cached_prices(elb_pricing_cache, pricing_keys), launch_times, utc_now)
+
 def calculate_bill_for_instance(instance_type, region_code, launch_time):
     """ calculates cost-to-date for a given EC2 instance using pricing info
     """
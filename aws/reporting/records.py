@@ -0,0 +1,140 @@
+"""
+    Compact records for collected AWS resources
+"""
+
+import threading
+from collections.abc import MutableMapping
+
+class _Missing(object):
+    """ type of MISSING, pickles and copies to the same object """
+    __slots__ = ()
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(_Missing, cls).__new__(cls)
+        return cls._instance
+
+    def __reduce__(self):
+        return 'MISSING'
+
+    def __repr__(self):
+        return 'MISSING'
+
+# marks a field which is not set on a record
+MISSING = _Missing()
+
+class Schema(object):
+    """ ordered list of field names shared by all records of a resource type
+    """
+    __slots__ = ('fields', 'index', '_lock')
+
+    def __init__(self, fields=()):
+        self.fields = []
+        self.index = {}
+        self._lock = threading.Lock()
+        for field in fields:
+            self.add(field)
+
+    def add(self, field):
+        """ returns position of the field, appending it if unknown,
+            records of one schema may be filled from several threads
+        """
+        idx = self.index.get(field)
+        if idx is None:
+            with self._lock:
+                idx = self.index.get(field)
+                if idx is None:
+                    idx = len(self.fields)
+                    self.fields.append(field)
+                    self.index[field] = idx
+        return idx
+
+    def __getstate__(self):
+        return list(self.fields)
+
+    def __setstate__(self, fields):
+        self.fields = []
+        self.index = {}
+        self._lock = threading.Lock()
+        for field in fields:
+            self.add(field)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __repr__(self):
+        return "Schema({})".format(self.fields)
+
+class Record(MutableMapping):
+    """ dict-like resource record backed by a list of values
+
+        field names live once in the shared schema instead of in
+        every item, fields set on a record which are not part of the
+        schema yet are appended to it
+    """
+    __slots__ = ('schema', 'values')
+
+    def __init__(self, schema, values=None):
+        self.schema = schema
+        self.values = values if values is not None else [MISSING] * len(schema)
+
+    def __getitem__(self, key):
+        idx = self.schema.index[key]
+        if idx >= len(self.values) or self.values[idx] is MISSING:
+            raise KeyError(key)
+        return self.values[idx]
+
+    def get(self, key, default=None):
+        idx = self.schema.index.get(key)
+        if idx is None or idx >= len(self.values):
+            return default
+        value = self.values[idx]
+        return default if value is MISSING else value
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def __setitem__(self, key, value):
+        idx = self.schema.add(key)
+        values = self.values
+        if idx >= len(values):
+            values.extend([MISSING] * (idx + 1 - len(values)))
+        values[idx] = value
+
+    def __delitem__(self, key):
+        idx = self.schema.index.get(key)
+        if idx is None or idx >= len(self.values) or self.values[idx] is MISSING:
+            raise KeyError(key)
+        self.values[idx] = MISSING
+
+    def __iter__(self):
+        for field, value in zip(self.schema.fields, self.values):
+            if value is not MISSING:
+                yield field
+
+    def __len__(self):
+        return sum(1 for value in self.values if value is not MISSING)
+
+    def copy(self):
+        return Record(self.schema, list(self.values))
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return "Record({})".format(self.to_dict())
+
+def shared_schema(rows):
+    """ returns the schema shared by all rows, None if rows are not
+        all records of a single schema
+    """
+    schema = None
+    for row in rows:
+        if not isinstance(row, Record):
+            return None
+        if schema is None:
+            schema = row.schema
+        elif row.schema is not schema:
+            return None
+    return schema
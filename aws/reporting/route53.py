@@ -1,9 +1,10 @@
-import boto3
 import logging
 from socket import socket
 from socket import AF_INET, SOCK_STREAM
 from socket import gaierror, herror, timeout
 
+from common import get_client
+
 
 logger = logging.getLogger(__name__)
 
@@ -27,7 +28,7 @@ def connection_test(base_url: str):
         count(0) > (limit/2) else False
 
 def delete_hosted_zones(dry_run = False):
-    client = boto3.client('route53')
+    client = get_client('route53')
     deleteable_zones = []
     try:
         zones = client.list_hosted_zones(MaxItems="500")
@@ -1,8 +1,16 @@
-import boto3
-from common import reformat_data
+import logging
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from common import reformat_data, get_client, sweep_regions, SWEEP_MAX_WORKERS
+
+logger = logging.getLogger(__name__)
+
+# max number of queries in a single get_metric_data call
+METRIC_QUERIES_PER_CALL = 500
 
 def get_all_buckets():
-    client = boto3.client('s3')
+    client = get_client('s3')
     return client.list_buckets()['Buckets']
 
 def reformat_buckets_data(buckets):
@@ -11,3 +19,73 @@ def reformat_buckets_data(buckets):
         'CreationDate',
     ]
     return reformat_data(buckets, keys)
+
+def get_bucket_region(bucket_name):
+    location = get_client('s3').get_bucket_location(Bucket=bucket_name).get('LocationConstraint')
+    # legacy location constraints
+    if not location:
+        return 'us-east-1'
+    if location == 'EU':
+        return 'eu-west-1'
+    return location
+
+def _bucket_sizes_per_region(region, bucket_names):
+    """ returns bucket name -> latest standard storage size in bytes,
+        read from the daily BucketSizeBytes metric
+    """
+    sizes = {}
+    client = get_client('cloudwatch', region)
+    end_time = datetime.now(tz=timezone.utc)
+    start_time = end_time - timedelta(days=3)
+    for i in range(0, len(bucket_names), METRIC_QUERIES_PER_CALL):
+        names = bucket_names[i:i+METRIC_QUERIES_PER_CALL]
+        queries = []
+        for idx, name in enumerate(names):
+            queries.append({
+                'Id': 'b{}'.format(idx),
+                'MetricStat': {
+                    'Metric': {
+                        'Namespace': 'AWS/S3',
+                        'MetricName': 'BucketSizeBytes',
+                        'Dimensions': [
+                            {'Name': 'BucketName', 'Value': name},
+                            {'Name': 'StorageType', 'Value': 'StandardStorage'},
+                        ]
+                    },
+                    'Period': 86400,
+                    'Stat': 'Average',
+                }
+            })
+        paginator = client.get_paginator('get_metric_data')
+        for page in paginator.paginate(MetricDataQueries=queries, StartTime=start_time, EndTime=end_time):
+            for result in page['MetricDataResults']:
+                if result['Values']:
+                    # newest datapoint comes first
+                    sizes[names[int(result['Id'][1:])]] = result['Values'][0]
+    return sizes
+
+def add_bucket_sizes(buckets):
+    """ adds Region and SizeGB to reformatted buckets
+    """
+    names = [bucket['Name'] for bucket in buckets]
+    regions = {}
+    with ThreadPoolExecutor(max_workers=SWEEP_MAX_WORKERS) as executor:
+        futures = [(name, executor.submit(get_bucket_region, name)) for name in names]
+        for name, future in futures:
+            try:
+                regions[name] = future.result()
+            except Exception as e:
+                logger.info("Error getting location of bucket {}".format(name))
+                logger.error(str(e))
+    names_per_region = {}
+    for name, region in regions.items():
+        names_per_region.setdefault(region, []).append(name)
+    def bucket_sizes_in_region(region):
+        return _bucket_sizes_per_region(region, names_per_region[region])
+    sizes = {}
+    for region_sizes in sweep_regions(bucket_sizes_in_region, regions=sorted(names_per_region.keys())).values():
+        sizes.update(region_sizes)
+    for bucket in buckets:
+        bucket['Region'] = regions.get(bucket['Name'], '')
+        bucket['SizeGB'] = round(sizes.get(bucket['Name'], 0.0) / 2**30, 3)
+    return buckets
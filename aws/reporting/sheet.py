@@ -1,132 +1,774 @@
 from __future__ import print_function
 
+import abc
 import datetime
+import json
+import logging
 import os.path
+import random
+import re
+import threading
+import time
 
 import pytz
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.errors import HttpError
+
+from records import shared_schema, MISSING
+
+logger = logging.getLogger(__name__)
+
+# sheets v4 discovery document to build the client from, the document
+# bundled with google-api-python-client is used when empty
+GOOGLE_DISCOVERY_PATH = os.environ.get('GOOGLE_DISCOVERY_PATH', '')
+
+# max rows read or written in a single request
+SHEET_CHUNK_ROWS = int(os.environ.get('SHEET_CHUNK_ROWS', '5000'))
+
+# sustained request rate and burst size of the per client token bucket,
+# keep the rate under the per user quota of the spreadsheets api
+SHEETS_REQUESTS_PER_MINUTE = int(os.environ.get('SHEETS_REQUESTS_PER_MINUTE', '60'))
+SHEETS_REQUESTS_BURST = int(os.environ.get('SHEETS_REQUESTS_BURST', '10'))
+
+# retries of throttled (429) and failed (5xx, idempotent only) requests, the delay before
+# retry n is drawn uniformly from [0, min(SHEETS_BACKOFF_MAX, SHEETS_BACKOFF_BASE * 2^n)]
+SHEETS_MAX_RETRIES = int(os.environ.get('SHEETS_MAX_RETRIES', '6'))
+SHEETS_BACKOFF_BASE = float(os.environ.get('SHEETS_BACKOFF_BASE', '1.0'))
+SHEETS_BACKOFF_MAX = float(os.environ.get('SHEETS_BACKOFF_MAX', '64.0'))
+
+# numeric columns rendered as dollar amounts
+CURRENCY_COLUMNS = set([
+    'TotalBill',
+    'Cost Per Day',
+    'CostPerDay',
+    'EC2 Daily Cost',
+    'ELBs Daily Cost',
+    'Volumes Daily Cost',
+    'EIPs Daily Cost',
+    'NAT Gateways Daily Cost',
+    'S3 Daily Cost',
+])
+
+# columns users edit by hand, always read fresh instead of from the run cache
+EDITABLE_COLUMNS = ('Saved', 'Notes')
+
+# tabs are read unformatted so numbers keep their precision and currency
+# cells read back as plain numbers, dates are read as displayed
+READ_OPTIONS = {'valueRenderOption': 'UNFORMATTED_VALUE', 'dateTimeRenderOption': 'FORMATTED_STRING'}
+
+_CURRENCY_CELL = re.compile(r'^(-?)\$(-?[\d,]*\.?\d+)$')
+_NUMBER_CELL = re.compile(r'^-?[\d,]*\.?\d+$')
+_DATE_CELL = re.compile(r'^(\d{1,2})/(\d{1,2})/(\d{4})$')
+
+def sheet_strings(row):
+    """ a written row the way it reads back from the sheet """
+    return [v if isinstance(v, str) else str(v) for v in row]
+
+def comparable_cell(value):
+    """ value of a cell as the sheet stores it, a written cell compares
+        equal to the same cell read back: "$1,250" and 1250 give 1250.0,
+        "03/05/2023" and "3/5/2023" give (2023, 3, 5)
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    value = str(value).strip()
+    match = _CURRENCY_CELL.match(value)
+    if match is not None:
+        value = match.group(1) + match.group(2)
+    if _NUMBER_CELL.match(value):
+        return float(value.replace(',', ''))
+    match = _DATE_CELL.match(value)
+    if match is not None:
+        return (int(match.group(3)), int(match.group(1)), int(match.group(2)))
+    return value
+
+def to_cell(column, value):
+    """ formats a single value for the sheet, values are kept typed
+        up to this point
+    """
+    if isinstance(value, datetime.date):
+        return value.strftime("%m/%d/%Y")
+    if column in CURRENCY_COLUMNS and isinstance(value, (int, float)) and not isinstance(value, bool):
+        return "${}".format(value)
+    return value
+
+def _is_retryable(error, idempotent=True):
+    """ throttled requests were not applied and are always retried, a
+        request failing with 5xx may have been applied and is only
+        retried when repeating it is harmless
+    """
+    return error.resp.status == 429 or (idempotent and error.resp.status >= 500)
+
+class RequestScheduler(object):
+    """ token bucket pacing the requests of a client, retries throttled
+        and server errors with jittered exponential backoff
+    """
+    def __init__(self, requests_per_minute=SHEETS_REQUESTS_PER_MINUTE, burst=SHEETS_REQUESTS_BURST,
+                    max_retries=SHEETS_MAX_RETRIES, backoff_base=SHEETS_BACKOFF_BASE):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = float(max(burst, 1))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        # requests sent, requests delayed by the bucket, retries after errors
+        self.requests = 0
+        self.throttled = 0
+        self.retried = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        """ takes a token, waits until the bucket refills when it is empty """
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.requests += 1
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            if wait:
+                self.throttled += 1
+        if wait:
+            time.sleep(wait)
+
+    def execute(self, request, idempotent=True):
+        """ executes an api request, returns its response, pass idempotent=False
+            for requests which must not run twice like appends
+        """
+        attempt = 0
+        while True:
+            self._acquire()
+            try:
+                return request.execute()
+            except HttpError as e:
+                if attempt >= self.max_retries or not _is_retryable(e, idempotent):
+                    raise
+                attempt += 1
+                delay = random.uniform(0, min(SHEETS_BACKOFF_MAX, self.backoff_base * 2**attempt))
+                with self._lock:
+                    self.retried += 1
+                logger.info("Sheets request failed with status {}, retry {} in {:.1f}s".format(
+                    e.resp.status, attempt, delay))
+                time.sleep(delay)
+
+    def stats(self):
+        return {'requests': self.requests, 'throttled': self.throttled, 'retried': self.retried}
 
 class GoogleSheetClient(object):
     SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
     
-    def __init__(self):
-        self.creds = None
+    def __init__(self, creds=None):
+        self.creds = creds
+        # spreadsheet id -> tab title -> tab properties
+        self._properties = {}
+        self.scheduler = RequestScheduler()
         self._init_spreadsheet_service()
 
+    def execute(self, request, idempotent=True):
+        """ executes a request built on self.service through the scheduler """
+        return self.scheduler.execute(request, idempotent)
+
+    def get_sheet_properties(self, sheet_id, sheet_name, refresh=False):
+        """ returns properties of a tab (sheetId, gridProperties), metadata
+            of all tabs of the spreadsheet is read in a single call
+        """
+        if refresh or sheet_id not in self._properties:
+            metadata = self.execute(self.service.spreadsheets().get(spreadsheetId=sheet_id,
+                fields='sheets.properties(sheetId,title,gridProperties)'))
+            self._properties[sheet_id] = dict((sheet['properties']['title'], sheet['properties'])
+                                                for sheet in metadata.get('sheets', []))
+        if sheet_name not in self._properties[sheet_id]:
+            raise Exception("sheet {} not found".format(sheet_name))
+        return self._properties[sheet_id][sheet_name]
+
+    def invalidate_properties(self, sheet_id):
+        """ writes may resize the grid, the next lookup reads it again """
+        self._properties.pop(sheet_id, None)
+
     def _init_spreadsheet_service(self):
-        if not os.path.exists('credentials.json'):
-            raise Exception("credentials.json not found")
+        if self.creds is None:
+            if not os.path.exists('credentials.json'):
+                raise Exception("credentials.json not found")
 
-        self.creds = service_account.Credentials.from_service_account_file('credentials.json', 
-            scopes=GoogleSheetClient.SCOPES)
+            self.creds = service_account.Credentials.from_service_account_file('credentials.json', 
+                scopes=GoogleSheetClient.SCOPES)
         
-        self.service = build('sheets', 'v4', credentials=self.creds)
+        self.service = build_sheets_service(self.creds)
+
+def build_sheets_service(creds, discovery_path=None, **kwargs):
+    """ builds the sheets service from discovery_path (GOOGLE_DISCOVERY_PATH)
+        when set, from the document bundled with google-api-python-client
+        otherwise, which build() already defaults to since 2.0, building
+        still parses the document, so share the service via get_sheet_client()
+    """
+    discovery_path = GOOGLE_DISCOVERY_PATH if discovery_path is None else discovery_path
+    if discovery_path:
+        with open(discovery_path) as fp:
+            return build_from_document(json.load(fp), credentials=creds, **kwargs)
+    return build('sheets', 'v4', credentials=creds, static_discovery=True, cache_discovery=False, **kwargs)
+
+_sheet_client = None
+_sheet_client_lock = threading.Lock()
 
-class GoogleSheetEditor():
-    def __init__(self, sheet_id, sheet_name, title_rows=3):
-        self.client = GoogleSheetClient()
+def get_sheet_client():
+    """ returns the process wide client, credentials and service are
+        built once and reused by every editor and warm Lambda invocation
+    """
+    global _sheet_client
+    if _sheet_client is None:
+        with _sheet_client_lock:
+            if _sheet_client is None:
+                start = time.time()
+                _sheet_client = GoogleSheetClient()
+                logger.info("Sheets client ready in {:.3f}s".format(time.time() - start))
+    return _sheet_client
+
+class SheetWriteBatch(object):
+    """ collects clears and value updates of every tab of a spreadsheet
+        and sends them as one batchClear and one batchUpdate call, values
+        are sent early once SHEET_CHUNK_ROWS rows are queued
+    """
+    def __init__(self, client, sheet_id):
+        self.client = client
         self.sheet_id = sheet_id
+        self.clears = []
+        # range -> values, a later update of the same range replaces the earlier one
+        self.updates = {}
+        self.pending_rows = 0
+        # (sheet name, spreadsheets.batchUpdate request), sent after the values
+        self.requests = []
+        # responses of values sent before flush
+        self.responses = []
+
+    def _sheet_of(self, a1_range):
+        return a1_range.split('!')[0]
+
+    def clear(self, a1_range):
+        if a1_range not in self.clears:
+            self.clears.append(a1_range)
+        # clears run first, earlier updates of the range would be wiped anyway
+        self.pending_rows -= len(self.updates.pop(a1_range, ()))
+
+    def update(self, a1_range, values):
+        self.pending_rows -= len(self.updates.pop(a1_range, ()))
+        self.updates[a1_range] = values
+        self.pending_rows += len(values)
+        if self.pending_rows >= SHEET_CHUNK_ROWS:
+            self.responses.extend(self._send_values())
+
+    def delete_rows(self, sheet_name, sheet_gid, start_index, end_index):
+        """ deletes rows [start_index, end_index) counted from 0, row
+            numbers of the queued value updates are the ones before deletion
+        """
+        self.requests.append((sheet_name, {
+            'deleteDimension': {
+                'range': {
+                    'sheetId': sheet_gid,
+                    'dimension': 'ROWS',
+                    'startIndex': start_index,
+                    'endIndex': end_index,
+                }
+            }
+        }))
+
+    def has_pending(self, sheet_name):
+        return any(self._sheet_of(r) == sheet_name for r in self.clears + list(self.updates.keys())) or \
+            any(name == sheet_name for name, _ in self.requests)
+
+    def _send_values(self):
+        """ sends queued clears and value updates, structural requests
+            wait for flush since their row numbers refer to the values
+        """
+        responses = []
+        values = self.client.service.spreadsheets().values()
+        if self.clears:
+            responses.append(self.client.execute(values.batchClear(spreadsheetId=self.sheet_id,
+                body={'ranges': self.clears})))
+        # every call carries at most SHEET_CHUNK_ROWS rows
+        data, rows = [], 0
+        for r, v in list(self.updates.items()) + [(None, None)]:
+            if data and (r is None or rows + len(v) > SHEET_CHUNK_ROWS):
+                responses.append(self.client.execute(values.batchUpdate(spreadsheetId=self.sheet_id,
+                    body={'valueInputOption': 'USER_ENTERED', 'data': data})))
+                data, rows = [], 0
+            if r is not None:
+                data.append({'range': r, 'values': v})
+                rows += len(v)
+        self.clears = []
+        self.updates = {}
+        self.pending_rows = 0
+        if responses:
+            self.client.invalidate_properties(self.sheet_id)
+        return responses
+
+    def flush(self):
+        """ sends all pending writes, returns the api responses """
+        responses = self.responses + self._send_values()
+        self.responses = []
+        if self.requests:
+            # row deletions shift the rows below, a repeat would delete other rows
+            responses.append(self.client.execute(self.client.service.spreadsheets().batchUpdate(
+                spreadsheetId=self.sheet_id, body={'requests': [request for _, request in self.requests]}),
+                idempotent=False))
+            self.client.invalidate_properties(self.sheet_id)
+        self.requests = []
+        return responses
+
+class SheetEditor(abc.ABC):
+    """ a tab of the report, rows below title_rows start with the labels,
+        implemented by GoogleSheetEditor and localsheet.LocalSheetEditor
+    """
+    def __init__(self, sheet_name, title_rows=3, key_fields=None):
         self.sheet_name = sheet_name
         # reserved rows for extra information like 
         # title and description of the spreadsheet
         self.title_rows = title_rows
-        
-    def _column_to_letter_identifier(self, column_id):
-        t, l = '', ''
-        while (column_id > 0):
-            t = (column_id - 1) % 26
-            l = chr(t + 65) + l
-            column_id = int((column_id - t - 1) / 26)
-        return l
+        # column(s) identifying a row
+        if isinstance(key_fields, str):
+            key_fields = (key_fields,)
+        self.key_fields = key_fields
 
-    def get_sheet_range(self):
-        return "{}!{}{}:Z".format(
-            self.sheet_name, 'A', self.title_rows+1)
-    
-    def get_custom_range(self, start, end):
-        return "{}!{}:{}".format(
-            self.sheet_name, start, end)
+    @abc.abstractmethod
+    def read_spreadsheet(self, indexField=None):
+        """ returns rows of the tab as list of dicts, or dict keyed by indexField """
 
+    @abc.abstractmethod
     def read_custom(self, start, end, indexField=None):
-        return self.client.service.spreadsheets().values().get(
-            spreadsheetId=self.sheet_id, range=self.get_custom_range(start, end)).execute().get('values', [])
-
-    def read_spreadsheet(self, indexField=None):
-        return self.from_sheet_data(self.client.service.spreadsheets().values().get(
-            spreadsheetId=self.sheet_id, range=self.get_sheet_range()).execute().get('values', []), indexField)
-    
-    def load_data_from_sheet(self):
-        return self.from_sheet_data(self.sheet.get('values', []))
+        """ returns cells of the range start:end, e.g. J1:J1, as list of rows """
 
-    def save_data_to_sheet(self, rows):
-        body = { 'values': self.to_sheet_data(rows) }
-        responses = []
-        responses.append(self.clear_previous_data())
-        responses.append(self._update_timestamp())
-        responses.append(self.client.service.spreadsheets().values().update(
-            spreadsheetId=self.sheet_id, range=self.get_sheet_range(),
-            valueInputOption='USER_ENTERED', body=body).execute())
-        return responses
+    @abc.abstractmethod
+    def save_data_to_sheet(self, rows, keep_missing=False):
+        """ replaces the rows of the tab, with keep_missing rows of the tab
+            whose key_fields are not in rows are kept
+        """
 
+    @abc.abstractmethod
     def append_data_to_sheet(self, rows):
-        body = { 'values': self.to_sheet_data(rows, skip_labels=True) }
-        responses = []
-        responses.append(self._update_timestamp())
-        responses.append(self.client.service.spreadsheets().values().append(
-            spreadsheetId=self.sheet_id, range="{}!A{}".format(self.sheet_name, self.title_rows+2),
-            valueInputOption='USER_ENTERED', body=body, insertDataOption='INSERT_ROWS').execute())
-        return responses
+        """ adds rows below the last row of the tab """
 
+    @abc.abstractmethod
     def clear_previous_data(self):
-        return self.client.service.spreadsheets().values().clear(
-            spreadsheetId=self.sheet_id, range=self.get_sheet_range()).execute()
-        
-    def _update_timestamp(self):
+        """ removes the rows below the title rows """
+
+    def iter_rows(self):
+        """ yields rows of the tab as dicts """
+        return iter(self.read_spreadsheet())
+
+    def _column_to_letter_identifier(self, column_id):
+        t, l = '', ''
+        while (column_id > 0):
+            t = (column_id - 1) % 26
+            l = chr(t + 65) + l
+            column_id = int((column_id - t - 1) / 26)
+        return l
+
+    def _timestamp_values(self):
         now = datetime.datetime.now(pytz.timezone('US/Eastern')).strftime("%H:%M:%S %B %d, %Y")
-        body = { 'values': [['Updated On', '{}'.format(now)]] }
-        return self.client.service.spreadsheets().values().update(
-            spreadsheetId=self.sheet_id, range="{}!{}".format(self.sheet_name, 'A3'),
-            valueInputOption='USER_ENTERED', body=body).execute()
+        return [['Updated On', '{}'.format(now)]]
 
     def from_sheet_data(self, data, indexField=None):
-        """ loads spredsheet data into list of dicts 
+        """ loads spredsheet data into list of dicts, data is left unchanged,
+            rows are padded to the widest row and cells past the labels
+            go to the '' column
         """
         if indexField == None:
             converted_data = []
         else:
             converted_data = {}
-        columns = data[0]
+        if not data:
+            return converted_data
+        width = max(len(row) for row in data)
+        columns = list(data[0]) + ['']*(width - len(data[0]))
+        padding = ['']*width
         for row in data[1:]:
-            row_dict = {}
-            while len(row) > len(columns):
-                columns.append('')  
-            while len(columns) > len(row):
-                row.append('')   
-            for idx, row_item in enumerate(row):
-                row_dict[columns[idx]] = row_item
+            if len(row) < width:
+                row = row + padding[len(row):]
+            row_dict = dict(zip(columns, row))
             if indexField == None:
                 converted_data.append(row_dict)
             else:
                 converted_data[row_dict[indexField]] = row_dict
         return converted_data
 
+    def _keep_missing_rows(self, data, current):
+        """ appends rows of current (sheet data, labels first) whose key is
+            not in data, e.g. when the inventory of some regions is missing,
+            columns are matched by label
+        """
+        if not current or not data:
+            return data
+        if self.key_fields is None or any(f not in data[0] or f not in current[0] for f in self.key_fields):
+            logger.info("{} Rows can not be matched by key, missing rows are not kept".format(self.sheet_name))
+            return data
+        labels, current_labels = data[0], current[0]
+        key_idx = [labels.index(f) for f in self.key_fields]
+        current_key_idx = [current_labels.index(f) for f in self.key_fields]
+
+        def key_of(row, idx):
+            return tuple(comparable_cell(row[i]) if i < len(row) else '' for i in idx)
+
+        keys = set(key_of(row, key_idx) for row in data[1:])
+        kept = []
+        for row in current[1:]:
+            if any(row) and key_of(row, current_key_idx) not in keys:
+                values = dict(zip(current_labels, row))
+                kept.append([values.get(label, '') for label in labels])
+        if kept:
+            logger.info("{} Kept {} rows missing from the new data".format(self.sheet_name, len(kept)))
+        return data + kept
+
+    def iter_sheet_dicts(self, rows):
+        """ converts spreadsheet rows (labels first) one at a time, rows
+            are padded to the labels and cells past them go to the '' column
+        """
+        rows = iter(rows)
+        labels = next(rows, None)
+        if labels is None:
+            return
+        labels = list(labels)
+        for row in rows:
+            if len(row) < len(labels):
+                row = row + ['']*(len(labels) - len(row))
+            yield dict(zip(labels + ['']*(len(row) - len(labels)), row))
+
+    def _records_to_sheet_data(self, rows, schema, skip_labels=False):
+        """ converts records of a single schema by position,
+            fields which are not set on any record are left out
+        """
+        present = [False] * len(schema)
+        for row in rows:
+            for idx, v in enumerate(row.values):
+                if v is not MISSING:
+                    present[idx] = True
+        positions = [idx for idx, p in enumerate(present) if p]
+        data = []
+        for row in rows:
+            values = row.values
+            current_row = []
+            for idx in positions:
+                v = values[idx] if idx < len(values) else MISSING
+                if v is MISSING:
+                    v = ''
+                else:
+                    v = to_cell(schema.fields[idx], v)
+                current_row.append(v)
+            data.append(current_row)
+        if skip_labels:
+            return data
+        return [[schema.fields[idx] for idx in positions]]+data
+
     def to_sheet_data(self, rows, skip_labels=False):
-        """ converts list of dicts into sheet compatible format
+        """ converts list of dicts or records into sheet compatible format
         """
+        schema = shared_schema(rows)
+        if schema is not None:
+            return self._records_to_sheet_data(rows, schema, skip_labels)
+        # fixed schema of all keys in order of appearance
+        column_index = {}
+        for row in rows:
+            for k in row:
+                if k not in column_index:
+                    column_index[k] = len(column_index)
+        column_labels = list(column_index.keys())
         data = []
-        column_labels = []
         for row in rows:
+            current_row = ['']*len(column_labels)
             for k, v in row.items():
-                if k not in column_labels:
-                    column_labels.append(k)
-            current_row = ['']*(max(len(column_labels), len(row.keys())))
-            for k, v in row.items():
-                idx = column_labels.index(k)
-                if isinstance(v, datetime.date):
-                    v = v.strftime("%m/%d/%Y")
-                current_row[idx] = v
+                current_row[column_index[k]] = to_cell(k, v)
             data.append(current_row)
         if skip_labels:
             return data
         return [column_labels]+data
+
+class GoogleSheetEditor(SheetEditor):
+    def __init__(self, sheet_id, sheet_name, title_rows=3, batch=None, key_fields=None, client=None):
+        """ client (GoogleSheetClient): defaults to the shared get_sheet_client()
+            batch (SheetWriteBatch): when given, writes are queued in the
+                                    batch until it is flushed
+            key_fields (str|tuple): column(s) identifying a row, when given
+                                    saves only write rows which changed
+        """
+        if client is None:
+            client = batch.client if batch is not None else get_sheet_client()
+        super(GoogleSheetEditor, self).__init__(sheet_name, title_rows, key_fields)
+        self.client = client
+        self.sheet_id = sheet_id
+        self.batch = batch
+        # contents of the tab, labels first, as written or read during this run
+        self._cache = None
+
+    def _flush_pending_writes(self):
+        """ reads must see queued writes of this tab """
+        if self.batch is not None and self.batch.has_pending(self.sheet_name):
+            self.batch.flush()
+        
+    def get_sheet_range(self):
+        """ data range below the title rows, over all columns of the grid,
+            grid properties are read again after every write
+        """
+        column_count = self.get_grid_properties().get('columnCount', 26)
+        return "{}!{}{}:{}".format(
+            self.sheet_name, 'A', self.title_rows+1, self._column_to_letter_identifier(column_count))
+
+    def get_grid_properties(self, refresh=False):
+        return self.client.get_sheet_properties(self.sheet_id, self.sheet_name, refresh).get('gridProperties', {})
+
+    def iter_sheet_values(self, chunk_rows=None):
+        """ yields rows of the data range, labels first, reading at most
+            chunk_rows rows per request, trailing empty rows are left out
+        """
+        chunk_rows = chunk_rows or SHEET_CHUNK_ROWS
+        row_count = self.get_grid_properties().get('rowCount', 0)
+        start = self.title_rows + 1
+        blank_rows = 0
+        while start <= row_count:
+            end = min(start + chunk_rows - 1, row_count)
+            rows = self.client.execute(self.client.service.spreadsheets().values().get(
+                spreadsheetId=self.sheet_id, range="{}!{}:{}".format(self.sheet_name, start, end),
+                **READ_OPTIONS)).get('values', [])
+            if rows:
+                # empty rows between chunks keep their position
+                for _ in range(blank_rows):
+                    yield []
+                for row in rows:
+                    yield sheet_strings(row)
+                blank_rows = 0
+            blank_rows += end - start + 1 - len(rows)
+            start = end + 1
+
+    def _queue_rows(self, batch, first_row, rows):
+        """ queues rows written from column A of first_row on, in chunks """
+        for i in range(0, len(rows), SHEET_CHUNK_ROWS):
+            batch.update("{}!A{}".format(self.sheet_name, first_row + i), rows[i:i+SHEET_CHUNK_ROWS])
+    
+    def get_custom_range(self, start, end):
+        return "{}!{}:{}".format(
+            self.sheet_name, start, end)
+
+    def read_custom(self, start, end, indexField=None):
+        self._flush_pending_writes()
+        return self.client.execute(self.client.service.spreadsheets().values().get(
+            spreadsheetId=self.sheet_id, range=self.get_custom_range(start, end))).get('values', [])
+
+    def read_spreadsheet(self, indexField=None):
+        return self.from_sheet_data(self._read_values(), indexField)
+
+    def iter_rows(self):
+        """ yields rows as dicts, a tab which is not cached in this run is
+            streamed chunk by chunk instead of being kept in memory
+        """
+        if self._cache is not None:
+            return self.iter_sheet_dicts(self._read_values())
+        self._flush_pending_writes()
+        return self.iter_sheet_dicts(self.iter_sheet_values())
+
+    def invalidate_cache(self):
+        """ makes the next read fetch the whole tab again """
+        self._cache = None
+
+    def _read_values(self):
+        """ returns the tab contents, labels first, tabs already written
+            or read in this run are served from memory except for
+            EDITABLE_COLUMNS, the rows are the cached ones and must not
+            be modified
+        """
+        if self._cache is None:
+            self._flush_pending_writes()
+            self._cache = list(self.iter_sheet_values())
+        else:
+            self._refresh_editable_columns()
+        return self._cache
+
+    def _refresh_editable_columns(self):
+        """ reads EDITABLE_COLUMNS of the cached tab, rows are matched by
+            key_fields when the tab has them, by position otherwise
+        """
+        if len(self._cache) < 2:
+            return
+        labels = self._cache[0]
+        editable = [labels.index(c) for c in EDITABLE_COLUMNS if c in labels]
+        if not editable:
+            return
+        key_idx = []
+        if self.key_fields is not None and all(f in labels for f in self.key_fields):
+            key_idx = [labels.index(f) for f in self.key_fields]
+        self._flush_pending_writes()
+        ranges = []
+        for idx in key_idx + editable:
+            letter = self._column_to_letter_identifier(idx + 1)
+            ranges.append("{}!{}{}:{}".format(self.sheet_name, letter, self.title_rows+1, letter))
+        response = self.client.execute(self.client.service.spreadsheets().values().batchGet(
+            spreadsheetId=self.sheet_id, ranges=ranges, majorDimension='COLUMNS', **READ_OPTIONS))
+        columns = [sheet_strings((r.get('values') or [[]])[0]) for r in response.get('valueRanges', [])]
+        key_columns, edit_columns = columns[:len(key_idx)], columns[len(key_idx):]
+
+        def cell(column, i):
+            return column[i] if i < len(column) else ''
+
+        fresh = {}
+        if key_idx:
+            for i in range(1, max(len(c) for c in columns)):
+                fresh[tuple(cell(c, i) for c in key_columns)] = [cell(c, i) for c in edit_columns]
+        for pos, row in enumerate(self._cache[1:], 1):
+            if key_idx:
+                key = tuple(row[k] if k < len(row) else '' for k in key_idx)
+                values = fresh.get(key, ['']*len(editable))
+            else:
+                values = [cell(c, pos) for c in edit_columns]
+            if len(row) < len(labels):
+                row.extend(['']*(len(labels) - len(row)))
+            for idx, v in zip(editable, values):
+                row[idx] = v
+    
+    def load_data_from_sheet(self):
+        return self.from_sheet_data(self.sheet.get('values', []))
+
+    def save_data_to_sheet(self, rows, keep_missing=False):
+        data = self.to_sheet_data(rows)
+        if keep_missing:
+            data = self._keep_missing_rows(data, self._read_values())
+        if self.key_fields is not None:
+            responses = self._save_changed_rows(data)
+            if responses is not None:
+                return responses
+        batch = self.batch if self.batch is not None else SheetWriteBatch(self.client, self.sheet_id)
+        batch.clear(self.get_sheet_range())
+        batch.update(self._timestamp_range(), self._timestamp_values())
+        self._queue_rows(batch, self.title_rows+1, data)
+        self._cache = [sheet_strings(row) for row in data]
+        if batch is self.batch:
+            return []
+        return batch.flush()
+
+    def get_sheet_gid(self):
+        """ returns numeric id of the tab, needed by structural updates """
+        return self.client.get_sheet_properties(self.sheet_id, self.sheet_name)['sheetId']
+
+    def _diff_rows(self, current, data):
+        """ matches rows of sheet data (labels first) with the current
+            contents of the tab by key_fields
+
+            returns (changed, deleted), changed maps positions among current
+            data rows to new rows, positions past the end are appended, deleted
+            lists positions to remove, None when rows can not be matched
+        """
+        if not current or not data or current[0] != data[0]:
+            return None
+        labels = data[0]
+        if any(field not in labels for field in self.key_fields):
+            return None
+        key_idx = [labels.index(field) for field in self.key_fields]
+        width = len(labels)
+
+        def normalized(row):
+            # written and read back cells only differ in formatting
+            row = [comparable_cell(v) for v in row[:width]]
+            return row + ['']*(width - len(row))
+
+        current_rows = [normalized(row) for row in current[1:]]
+        positions = {}
+        for i, row in enumerate(current_rows):
+            key = tuple(row[idx] for idx in key_idx)
+            if key in positions:
+                return None
+            positions[key] = i
+        changed = {}
+        kept = set()
+        added = []
+        for row in data[1:]:
+            new_row = normalized(row)
+            key = tuple(new_row[idx] for idx in key_idx)
+            i = positions.get(key)
+            if i is None:
+                added.append(row)
+            elif i in kept:
+                return None
+            else:
+                kept.add(i)
+                if current_rows[i] != new_row:
+                    changed[i] = row
+        removed = [i for i in range(len(current_rows)) if i not in kept]
+        # new rows take over the slots of removed ones before the tab grows or shrinks
+        for i, row in zip(removed, added):
+            changed[i] = row
+        for j, row in enumerate(added[len(removed):]):
+            changed[len(current_rows) + j] = row
+        return changed, removed[len(added):]
+
+    def _save_changed_rows(self, data):
+        """ writes only rows which differ from the tab, None when the tab
+            has to be rewritten as a whole
+        """
+        # rows are replaced below, the list itself becomes the new cache
+        current = list(self._read_values())
+        diff = self._diff_rows(current, data)
+        if diff is None:
+            return None
+        changed, deleted = diff
+        # the cache follows the tab layout after the writes below
+        for i in sorted(changed):
+            if i + 1 < len(current):
+                current[i + 1] = sheet_strings(changed[i])
+            else:
+                current.append(sheet_strings(changed[i]))
+        for i in sorted(deleted, reverse=True):
+            del current[i + 1]
+        self._cache = current
+        width = len(data[0])
+        batch = self.batch if self.batch is not None else SheetWriteBatch(self.client, self.sheet_id)
+        batch.update(self._timestamp_range(), self._timestamp_values())
+        # first sheet row of the data, right below the labels
+        first_row = self.title_rows + 2
+        run = []
+        for i in sorted(changed) + [None]:
+            if run and (i is None or i != run[-1] + 1):
+                self._queue_rows(batch, first_row + run[0],
+                    [list(changed[r]) + ['']*(width - len(changed[r])) for r in run])
+                run = []
+            if i is not None:
+                run.append(i)
+        # contiguous runs, bottom up so earlier deletes do not shift later ones
+        start = end = None
+        for i in sorted(deleted, reverse=True) + [None]:
+            if end is not None and (i is None or i != start - 1):
+                batch.delete_rows(self.sheet_name, self.get_sheet_gid(), first_row - 1 + start, first_row - 1 + end)
+                end = None
+            if i is not None:
+                if end is None:
+                    end = i + 1
+                start = i
+        logger.info("{} Saved {} changed rows, deleted {} rows".format(self.sheet_name, len(changed), len(deleted)))
+        if batch is self.batch:
+            return []
+        return batch.flush()
+
+    def append_data_to_sheet(self, rows):
+        body = { 'values': self.to_sheet_data(rows, skip_labels=True) }
+        if self._cache is not None:
+            self._cache.extend(sheet_strings(row) for row in body['values'])
+        responses = []
+        if self.batch is not None:
+            self.batch.update(self._timestamp_range(), self._timestamp_values())
+        else:
+            responses.append(self._update_timestamp())
+        responses.append(self.client.execute(self.client.service.spreadsheets().values().append(
+            spreadsheetId=self.sheet_id, range="{}!A{}".format(self.sheet_name, self.title_rows+2),
+            valueInputOption='USER_ENTERED', body=body, insertDataOption='INSERT_ROWS'), idempotent=False))
+        # inserted rows grow the grid
+        self.client.invalidate_properties(self.sheet_id)
+        return responses
+
+    def clear_previous_data(self):
+        self._cache = None
+        return self.client.execute(self.client.service.spreadsheets().values().clear(
+            spreadsheetId=self.sheet_id, range=self.get_sheet_range()))
+        
+    def _timestamp_range(self):
+        return "{}!{}".format(self.sheet_name, 'A3')
+
+    def _update_timestamp(self):
+        body = { 'values': self._timestamp_values() }
+        return self.client.execute(self.client.service.spreadsheets().values().update(
+            spreadsheetId=self.sheet_id, range=self._timestamp_range(),
+            valueInputOption='USER_ENTERED', body=body))
@@ -0,0 +1,196 @@
+"""
+    Report outputs other than the sheet, rows are
+    streamed to files one at a time
+"""
+
+import os
+import csv
+import gzip
+import json
+import logging
+import datetime
+
+logger = logging.getLogger(__name__)
+
+# comma separated formats written by every report run: csv, jsonl,
+# csv.gz or jsonl.gz, empty to write the sheet only
+REPORT_SINKS = os.environ.get('REPORT_SINKS', '')
+
+# directory of the files, one per report and format, e.g. instances.csv
+REPORT_SINKS_DIR = os.environ.get('REPORT_SINKS_DIR', './reports')
+
+def _plain(value):
+    """ converts a value to what csv / json can write """
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if value is None:
+        return ''
+    return value
+
+def _csv_cell(value):
+    """ nested values of raw api responses are written as json """
+    if isinstance(value, (list, tuple, dict)):
+        return json.dumps(value, default=_json_default)
+    return _plain(value)
+
+def _json_default(value):
+    plain = _plain(value)
+    return plain if plain is not value else str(value)
+
+def _columns_of(rows):
+    """ keys set on any of the rows in order of appearance, fields a
+        schema holds without a value on these rows are left out
+    """
+    columns = {}
+    for row in rows:
+        for k in row.keys():
+            columns.setdefault(k, None)
+    return list(columns)
+
+class FileSink(object):
+    """ writes each report to <directory>/<name>.<extension>, the file is
+        replaced only once the report is complete
+    """
+    extension = ''
+
+    def __init__(self, directory, compress=False):
+        self.directory = directory
+        self.compress = compress
+
+    def path(self, name):
+        path = os.path.join(self.directory, '{}.{}'.format(name, self.extension))
+        return path + '.gz' if self.compress else path
+
+    def open(self, name, columns):
+        """ returns a writer with write(row) and close() """
+        os.makedirs(self.directory, exist_ok=True)
+        return self.writer_class(self.path(name), columns, self.compress)
+
+class _FileWriter(object):
+    def __init__(self, path, columns, compress):
+        self.path = path
+        self.columns = columns
+        self.tmp_path = '{}.tmp'.format(path)
+        if compress:
+            self.fp = gzip.open(self.tmp_path, 'wt', newline='')
+        else:
+            self.fp = open(self.tmp_path, 'w', newline='')
+
+    def close(self, complete=True):
+        self.fp.close()
+        if complete:
+            os.replace(self.tmp_path, self.path)
+        else:
+            os.remove(self.tmp_path)
+
+class _CsvWriter(_FileWriter):
+    def __init__(self, path, columns, compress):
+        super(_CsvWriter, self).__init__(path, columns, compress)
+        self.writer = csv.writer(self.fp)
+        self.writer.writerow(columns)
+        self.column_set = set(columns)
+        self.dropped = set()
+
+    def write(self, row):
+        # the header is written first, columns showing up later are left out
+        for k in row.keys():
+            if k not in self.column_set and k not in self.dropped:
+                self.dropped.add(k)
+                logger.error("{} Column {} missing from the header, not written".format(self.path, k))
+        self.writer.writerow([_csv_cell(row.get(column, '')) for column in self.columns])
+
+class _JsonLinesWriter(_FileWriter):
+    def write(self, row):
+        self.fp.write(json.dumps(dict((k, _plain(v)) for k, v in row.items()), default=_json_default))
+        self.fp.write('\n')
+
+class CsvSink(FileSink):
+    extension = 'csv'
+    writer_class = _CsvWriter
+
+class JsonLinesSink(FileSink):
+    extension = 'jsonl'
+    writer_class = _JsonLinesWriter
+
+SINK_FORMATS = {
+    'csv': CsvSink,
+    'jsonl': JsonLinesSink,
+}
+
+def open_sinks(formats=REPORT_SINKS, directory=REPORT_SINKS_DIR):
+    """ returns sinks of the comma separated formats """
+    sinks = []
+    for sink_format in formats.split(','):
+        sink_format = sink_format.strip()
+        if not sink_format:
+            continue
+        compress = sink_format.endswith('.gz')
+        if compress:
+            sink_format = sink_format[:-len('.gz')]
+        if sink_format not in SINK_FORMATS:
+            raise Exception("unknown report sink {}".format(sink_format))
+        sinks.append(SINK_FORMATS[sink_format](directory, compress=compress))
+    return sinks
+
+class RowStream(object):
+    """ writes a report to all sinks while its rows are produced, e.g. one
+        region at a time, the columns default to the keys set on the first
+        batch, pass them when later rows may set other keys
+
+        files are only replaced when the stream is closed after a complete
+        report, used as a context manager an exception discards them
+    """
+    def __init__(self, sinks, name, columns=None):
+        self.sinks = sinks
+        self.name = name
+        self.columns = columns
+        self.writers = None
+        self.count = 0
+
+    def extend(self, rows):
+        """ writes a batch of rows (dicts or records) """
+        if not self.sinks:
+            return
+        if self.writers is None:
+            rows = list(rows)
+            if not rows:
+                return
+            columns = self.columns if self.columns is not None else _columns_of(rows)
+            self.writers = [sink.open(self.name, columns) for sink in self.sinks]
+        for row in rows:
+            for writer in self.writers:
+                writer.write(row)
+            self.count += 1
+
+    def close(self, complete=True):
+        if not self.sinks:
+            return
+        if self.writers is None:
+            self.writers = [sink.open(self.name, self.columns or []) for sink in self.sinks]
+        for writer in self.writers:
+            writer.close(complete)
+        if complete:
+            logger.info("Wrote {} {} rows to {} sinks".format(self.count, self.name, len(self.sinks)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        self.close(exc_type is None)
+
+def open_stream(sinks, name, columns=None):
+    return RowStream(sinks, name, columns)
+
+def stream_rows(sinks, name, rows, columns=None):
+    """ writes rows (dicts or records, any iterable) to all sinks in a
+        single pass, columns default to the keys set on any row of a list,
+        or to the keys of the first row of other iterables
+
+        returns number of rows written
+    """
+    if columns is None and isinstance(rows, (list, tuple)):
+        columns = _columns_of(rows)
+    with open_stream(sinks, name, columns) as stream:
+        for row in rows:
+            stream.extend([row])
+    return stream.count
@@ -0,0 +1,309 @@
+"""
+    Versioned columnar inventory snapshots which
+    are read through a memory map
+
+    layout: magic, header length (uint64 little endian), json header,
+    then one 8 byte aligned block per column buffer. Columns hold
+    int64, float64, timestamp (float64 epoch seconds, UTC), str
+    (int64 offsets + utf-8 data) or json (same layout as str) values,
+    columns with missing values add a block of validity bytes
+"""
+
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+import logging
+import datetime
+from array import array
+from collections.abc import Sequence, MutableMapping
+
+from records import Schema, MISSING
+
+logger = logging.getLogger(__name__)
+
+# snapshot written by report and read by the purge commands, /tmp is the
+# only writable path in Lambda and is kept while the container stays warm
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH', '/tmp/inventory.snapshot')
+
+# comma separated tables the report writes: instances, vpcs, vpcs take
+# an extra sweep of all regions, purge_vpcs queries AWS without them
+SNAPSHOT_TABLES = os.environ.get('SNAPSHOT_TABLES', 'instances')
+
+# seconds after which a snapshot is stale and live data is used instead
+SNAPSHOT_MAX_AGE = int(os.environ.get('SNAPSHOT_MAX_AGE', str(26 * 3600)))
+
+SNAPSHOT_MAGIC = b'AWSSNAP\x00'
+SNAPSHOT_VERSION = 1
+
+ALIGNMENT = 8
+
+def _padding(size):
+    return (-size) % ALIGNMENT
+
+def _column_type(values):
+    """ returns storage type of the set values of a column """
+    kinds = set()
+    for v in values:
+        if isinstance(v, bool):
+            return 'json'
+        if isinstance(v, int):
+            kinds.add('int64')
+        elif isinstance(v, float):
+            kinds.add('float64')
+        elif isinstance(v, datetime.datetime) and v.tzinfo is not None:
+            kinds.add('timestamp')
+        elif isinstance(v, str):
+            kinds.add('str')
+        else:
+            return 'json'
+    if kinds == set(['int64', 'float64']):
+        return 'float64'
+    if len(kinds) > 1:
+        return 'json'
+    return kinds.pop() if kinds else 'str'
+
+def _encode_column(values, column_type):
+    """ returns buffers of a column, validity first when values are missing """
+    buffers = []
+    if any(v is MISSING for v in values):
+        buffers.append(bytes(bytearray(0 if v is MISSING else 1 for v in values)))
+    if column_type == 'int64':
+        buffers.append(array('q', (0 if v is MISSING else v for v in values)).tobytes())
+    elif column_type == 'float64':
+        buffers.append(array('d', (0.0 if v is MISSING else v for v in values)).tobytes())
+    elif column_type == 'timestamp':
+        buffers.append(array('d', (0.0 if v is MISSING else v.timestamp() for v in values)).tobytes())
+    else:
+        offsets = array('q', [0])
+        data = bytearray()
+        for v in values:
+            if v is not MISSING:
+                data += (v if column_type == 'str' else json.dumps(v, default=str)).encode('utf-8')
+            offsets.append(len(data))
+        buffers.append(offsets.tobytes())
+        buffers.append(bytes(data))
+    return buffers
+
+def write_snapshot(path, tables):
+    """ writes tables (name -> list of dicts or records) to path,
+        columns are the union of the keys in order of appearance
+    """
+    header = {'version': SNAPSHOT_VERSION, 'created': time.time(),
+              'byteorder': sys.byteorder, 'tables': {}}
+    blocks = []
+    offset = 0
+    for name, rows in tables.items():
+        columns = {}
+        for row in rows:
+            for k in row:
+                columns.setdefault(k, None)
+        table = {'rows': len(rows), 'columns': []}
+        for column in columns:
+            values = [row.get(column, MISSING) for row in rows]
+            column_type = _column_type(v for v in values if v is not MISSING)
+            buffers = _encode_column(values, column_type)
+            entry = {'name': column, 'type': column_type, 'buffers': []}
+            for buf in buffers:
+                entry['buffers'].append([offset, len(buf)])
+                blocks.append(buf)
+                blocks.append(b'\x00' * _padding(len(buf)))
+                offset += len(buf) + _padding(len(buf))
+            entry['valid'] = len(buffers) == (3 if column_type in ('str', 'json') else 2)
+            table['columns'].append(entry)
+        header['tables'][name] = table
+    header_bytes = json.dumps(header).encode('utf-8')
+    prefix = SNAPSHOT_MAGIC + struct.pack('<Q', len(header_bytes)) + header_bytes
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'wb') as fp:
+        fp.write(prefix)
+        fp.write(b'\x00' * _padding(len(prefix)))
+        for block in blocks:
+            fp.write(block)
+    os.replace(tmp_path, path)
+
+class SnapshotColumn(Sequence):
+    """ values of a column read from the mapped buffers on access """
+    def __init__(self, name, column_type, length, buffers, swap=False):
+        self.name = name
+        self.type = column_type
+        self.length = length
+        # views into the mapped file, released when the snapshot is closed
+        self.views = list(buffers)
+        self.valid = None
+        if len(buffers) == (3 if column_type in ('str', 'json') else 2):
+            self.valid = buffers.pop(0)
+        if column_type in ('str', 'json'):
+            self.offsets = self._cast(buffers[0], 'q', swap)
+            self.data = buffers[1]
+        else:
+            self.data = self._cast(buffers[0], 'q' if column_type == 'int64' else 'd', swap)
+
+    def _cast(self, buf, fmt, swap):
+        if not swap:
+            view = buf.cast(fmt)
+            self.views.append(view)
+            return view
+        # snapshot written on a machine of the other byte order
+        values = array(fmt, buf.tobytes())
+        values.byteswap()
+        return values
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.length))]
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        if self.valid is not None and not self.valid[i]:
+            return MISSING
+        if self.type == 'str':
+            return str(self.data[self.offsets[i]:self.offsets[i+1]], 'utf-8')
+        if self.type == 'json':
+            return json.loads(str(self.data[self.offsets[i]:self.offsets[i+1]], 'utf-8'))
+        if self.type == 'timestamp':
+            return datetime.datetime.fromtimestamp(self.data[i], datetime.timezone.utc)
+        return self.data[i]
+
+class SnapshotRow(MutableMapping):
+    """ row of a table, values are decoded from the columns when they
+        are accessed, values set on the row are kept aside
+    """
+    __slots__ = ('table', 'index', 'convert', 'changes')
+
+    def __init__(self, table, index, convert=None):
+        self.table = table
+        self.index = index
+        self.convert = convert
+        self.changes = {}
+
+    def __getitem__(self, key):
+        if key in self.changes:
+            value = self.changes[key]
+        else:
+            idx = self.table.schema.index.get(key)
+            value = MISSING if idx is None else self.table.columns[idx][self.index]
+            if value is not MISSING and self.convert is not None:
+                value = self.convert(key, value)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.changes[key] = value
+
+    def __delitem__(self, key):
+        self[key]
+        self.changes[key] = MISSING
+
+    def __iter__(self):
+        for key in self.table.schema.fields:
+            if key in self:
+                yield key
+        for key, value in self.changes.items():
+            if key not in self.table.schema.index and value is not MISSING:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return 'SnapshotRow({})'.format(dict(self))
+
+class SnapshotTable(object):
+    def __init__(self, name, columns, length):
+        self.name = name
+        self.columns = columns
+        self.length = length
+        self.schema = Schema(column.name for column in columns)
+
+    def __len__(self):
+        return self.length
+
+    def column(self, name):
+        return self.columns[self.schema.index[name]]
+
+    def rows(self, convert=None):
+        """ yields rows which read their values from the mapped columns on
+            access, convert(column, value) is applied to the values read,
+            rows are only valid until the snapshot is closed
+        """
+        for i in range(self.length):
+            yield SnapshotRow(self, i, convert)
+
+class Snapshot(object):
+    """ snapshot file mapped into memory, columns decode values
+        only when they are accessed
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tables = {}
+        with open(path, 'rb') as fp:
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buf = memoryview(self._mm)
+        if bytes(self._buf[:len(SNAPSHOT_MAGIC)]) != SNAPSHOT_MAGIC:
+            self.close()
+            raise Exception("{} is not a snapshot".format(path))
+        header_length = struct.unpack_from('<Q', self._buf, len(SNAPSHOT_MAGIC))[0]
+        header_start = len(SNAPSHOT_MAGIC) + 8
+        self.header = json.loads(str(self._buf[header_start:header_start+header_length], 'utf-8'))
+        if self.header.get('version') != SNAPSHOT_VERSION:
+            self.close()
+            raise Exception("{} has unsupported snapshot version {}".format(path, self.header.get('version')))
+        self.created = self.header['created']
+        data_start = header_start + header_length
+        data_start += _padding(data_start)
+        swap = self.header.get('byteorder', sys.byteorder) != sys.byteorder
+        for name, table in self.header['tables'].items():
+            columns = []
+            for column in table['columns']:
+                buffers = [self._buf[data_start+offset:data_start+offset+length]
+                            for offset, length in column['buffers']]
+                columns.append(SnapshotColumn(column['name'], column['type'], table['rows'], buffers, swap))
+            self.tables[name] = SnapshotTable(name, columns, table['rows'])
+
+    def age(self):
+        return time.time() - self.created
+
+    def table(self, name):
+        return self.tables[name]
+
+    def close(self):
+        for table in self.tables.values():
+            for column in table.columns:
+                for view in column.views:
+                    view.release()
+        self.tables = {}
+        self._buf.release()
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def open_snapshot(path=SNAPSHOT_PATH, max_age=SNAPSHOT_MAX_AGE):
+    """ returns the snapshot at path, None when it is missing, unreadable
+        or older than max_age seconds
+    """
+    if not os.path.exists(path):
+        logger.info("Snapshot {} not found".format(path))
+        return None
+    try:
+        snapshot = Snapshot(path)
+    except Exception as e:
+        logger.info("Error reading snapshot {}".format(path))
+        logger.error(str(e))
+        return None
+    if max_age is not None and snapshot.age() > max_age:
+        logger.info("Snapshot {} is stale, created {:.0f}s ago".format(path, snapshot.age()))
+        snapshot.close()
+        return None
+    return snapshot
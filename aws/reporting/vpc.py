@@ -1,22 +1,78 @@
 import logging
 from time import sleep
 
-import boto3
-import boto3.session
-
-from common import get_all_regions
+from common import sweep_regions, merge_region_results, get_client, get_resource, \
+    iter_pages, build_filters, compile_keys
 
 logger = logging.getLogger(__name__)
 
+# default vpcs are never deleted, leave them out of the query
+CANDIDATE_VPC_RULES = {
+    'is-default': ['false'],
+}
+
+NAT_GATEWAY_KEYS = [
+    'NatGatewayId',
+    'VpcId',
+    'SubnetId',
+    'State',
+    'CreateTime',
+    'Tags.Name',
+    'Tags.owner',
+    'Tags.guid'
+]
+
+_project_nat_gateway = compile_keys(NAT_GATEWAY_KEYS)
+
+# nat gateways which are billed
+ACTIVE_NAT_GATEWAY_RULES = {
+    'state': ['pending', 'available'],
+}
+
+def get_all_nat_gateways():
+    schema = _project_nat_gateway.new_schema()
+    def nat_gateways_in_region(region):
+        return get_nat_gateways_per_region(region, schema=schema)
+    return merge_region_results(sweep_regions(nat_gateways_in_region))
+
+def get_nat_gateways_per_region(region, rules=ACTIVE_NAT_GATEWAY_RULES, schema=None):
+    if schema is None:
+        schema = _project_nat_gateway.new_schema()
+    gateways = []
+    client = get_client('ec2', region)
+    for nat in iter_pages(client, 'describe_nat_gateways', 'NatGateways', Filter=build_filters(rules)):
+        gateway = _project_nat_gateway(nat, schema)
+        gateway['Region'] = region
+        gateways.append(gateway)
+        logger.info("{} Found nat gateway {}".format(region, nat['NatGatewayId']))
+    return gateways
+
 def get_all_vpcs():
+    return sweep_regions(get_vpcs_per_region)
+
+def flatten_vpcs(vpcs):
+    """ turns region -> [vpcs] into a list of vpcs with Region """
+    rows = []
+    for region, region_vpcs in vpcs.items():
+        for vpc in region_vpcs:
+            row = {'Region': region}
+            row.update(vpc)
+            rows.append(row)
+    return rows
+
+def group_vpcs(rows):
+    """ inverse of flatten_vpcs, rows are grouped as they are and keep
+        their Region, snapshot rows only decode the fields used later
+    """
     vpcs = {}
-    for region in get_all_regions():
-        if vpcs.get(region, None) == None:
-            vpcs[region] = []
-        vpcs_in_region = boto3.client('ec2', region_name=region).describe_vpcs()['Vpcs']
-        vpcs[region].extend(vpcs_in_region)
+    for row in rows:
+        vpcs.setdefault(row['Region'], []).append(row)
     return vpcs
 
+def get_vpcs_per_region(region, rules=CANDIDATE_VPC_RULES):
+    return list(iter_pages(get_client('ec2', region), 'describe_vpcs', 'Vpcs',
+        Filters=build_filters(rules)))
+
 def _is_orphan(vpc_res):
     """ tries to identify whether vpc is orphan
         criteria of orphan includes:
@@ -33,9 +89,9 @@ def delete_orphan_vpcs(vpcs):
     """
     deleted_vpcs = 0
     for region in vpcs.keys():
-        session = boto3.session.Session(region_name=region)
-        client = session.resource('ec2')
+        client = get_resource('ec2', region)
         meta_client = client.meta.client
+        elbv2_client = get_client('elbv2', region)
         for vpc in vpcs[region]:
             try:
                 vpc_res = client.Vpc(vpc['VpcId'])
@@ -57,11 +113,11 @@ def delete_orphan_vpcs(vpcs):
             if dhcp_options_default:
                 dhcp_options_default.associate_with_vpc(VpcId=vpc_res.id)
             # delete load balancers
-            for elb in session.client('elbv2').describe_load_balancers()['LoadBalancers']:
+            for elb in elbv2_client.describe_load_balancers()['LoadBalancers']:
                 if elb['VpcId'] == vpc_res.id:
                     try:
                         logger.info("{} Attempting to delete elb {}".format(region, elb['LoadBalancerArn']))
-                        session.client('elbv2').delete_load_balancer(LoadBalancerArn=elb['LoadBalancerArn'])
+                        elbv2_client.delete_load_balancer(LoadBalancerArn=elb['LoadBalancerArn'])
                     except Exception as e:
                         logger.info("{} Error deleting elb {}".format(region, elb['LoadBalancerArn']))
                         logger.error(str(e))
@@ -102,12 +158,8 @@ def delete_orphan_vpcs(vpcs):
                     logger.info("{} Error deleting rt {}".format(region, rta.id))
                     logger.error(str(e))
             # delete endpoints
-            for eip in meta_client.describe_vpc_endpoints(Filters=[
-                    {
-                        'Name': 'vpc-id',
-                        'Values': [vpc_res.id]
-                    }
-                ])['VpcEndpoints']:
+            for eip in meta_client.describe_vpc_endpoints(
+                    Filters=build_filters({'vpc-id': vpc_res.id}))['VpcEndpoints']:
                 try:
                     logger.info("{} Attempting to delete endpoint {}".format(region, eip['VpcEndpointId']))
                     meta_client.delete_vpc_endpoints(VpcEndpointIds=[eip['VpcEndpointId']])
@@ -136,12 +188,8 @@ def delete_orphan_vpcs(vpcs):
                     logger.info("{} Failed deleting sec group {}".format(region, sg.id))
                     logger.error(str(e))
             # delete peering connections
-            for pconn in meta_client.describe_vpc_peering_connections(Filters=[
-                    {
-                        'Name': 'requester-vpc-info.vpc-id',
-                        'Values': [vpc_res.id]
-                    }
-                ])['VpcPeeringConnections']:
+            for pconn in meta_client.describe_vpc_peering_connections(
+                    Filters=build_filters({'requester-vpc-info.vpc-id': vpc_res.id}))['VpcPeeringConnections']:
                 try:
                     logger.info("{} Attempting to delete peering conn {}".format(region, pconn['VpcPeeringConnectionId']))
                     client.VpcPeeringConnection(pconn['VpcPeeringConnectionId']).delete()
@@ -173,12 +221,8 @@ def delete_orphan_vpcs(vpcs):
                     logger.info("{} Error deleting subnet {}".format(region, subnet.id))
                     logger.error(str(e))
             # delete nat gateways
-            for nat in meta_client.describe_nat_gateways(Filters=[
-                    {
-                        'Name': 'vpc-id',
-                        'Values': [vpc_res.id]
-                    }
-                ])['NatGateways']:
+            for nat in meta_client.describe_nat_gateways(
+                    Filter=build_filters({'vpc-id': vpc_res.id}))['NatGateways']:
                 try:
                     logger.info("{} Attempting to delete nat gateway {}".format(region, nat['NatGatewayId']))
                     meta_client.delete_nat_gateway(NatGatewayId=nat['NatGatewayId'])